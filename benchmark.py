@@ -0,0 +1,324 @@
+#!/usr/bin/env python3.10
+
+"""
+Load generator and benchmark for the chatroom
+
+Starts a number of servers and simulated clients on 127.0.0.1, so nothing goes over the network and no broadcasts
+are needed. The first server starts as the leader and the others join it directly
+Every client sends chats at a fixed rate through client.message_to_server, and records when each chat reaches it
+With --rooms, the clients are spread evenly over that many chat rooms
+
+Reported:
+- end to end delivery latency, from a client sending a chat to each client receiving it
+- chats sent per second and deliveries per second
+- retransmissions: NACKs sent and messages resent to the clients
+- how long the multicasts took to be committed, that is stored by enough other servers (see REPLICATION_QUORUM)
+- with --failover, how long after killing the leader the clients hear about the new leader,
+  and how long until a chat is delivered again
+- the metrics of every server at the end of the run (see stats.py)
+
+The results are also written as JSON, so runs of different versions can be compared
+
+Usage: python benchmark.py --servers 3 --clients 10 --rate 20 --duration 10 --failover --output results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+BENCHMARK_IP = '127.0.0.1'
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Chats sent by the benchmark start with this, followed by 'client id:sequence number:send time'
+CHAT_PREFIX = 'bench'
+# Time for a client that moved to another room to start listening on the room's group
+ROOM_SETTLE_TIME = 0.6
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Chatroom load generator and benchmark')
+    parser.add_argument('--servers', type=int, default=1, help='number of servers to start')
+    parser.add_argument('--clients', type=int, default=4, help='number of simulated clients')
+    parser.add_argument('--rate', type=float, default=10, help='chats sent per second by each client')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send chats for')
+    parser.add_argument('--size', type=int, default=32, help='length of each chat in characters')
+    parser.add_argument('--rooms', type=int, default=1, help='number of chat rooms to spread the clients over')
+    parser.add_argument('--drain', type=float, default=2, help='seconds to wait for deliveries after sending stops')
+    parser.add_argument('--failover', action='store_true', help='kill the leader after the run and time the failover')
+    parser.add_argument('--wire-format', choices=('repr', 'binary'), default='repr')
+    parser.add_argument('--server-args', default='', help='extra arguments for every server, e.g. "--asyncio"')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the servers')
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((BENCHMARK_IP, 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((BENCHMARK_IP, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+def start_server(port, arguments, join_port=None):
+    env = dict(os.environ, CHATROOM_IP=BENCHMARK_IP, CHATROOM_PORT=str(port))
+    command = [sys.executable, os.path.join(REPO_DIRECTORY, 'server.py'), '--wire-format', arguments.wire_format,
+               *arguments.server_args.split()]
+    command += ['--join', f'{BENCHMARK_IP}:{join_port}'] if join_port else ['--leader']
+    output = None if arguments.verbose else subprocess.DEVNULL
+    return subprocess.Popen(command, env=env, stdout=output, stderr=output, cwd=REPO_DIRECTORY)
+
+
+# Runs a simulated client in its own process, so every client has its own copy of the client module
+def client_worker(worker_id, server, config, control, results):
+    sys.stdout = open(os.devnull, 'w')  # The client prints every chat
+    import client
+    import utility
+    utility.WIRE_FORMAT = config['wire_format']
+
+    room = f'room{worker_id % config["rooms"]}' if config['rooms'] > 1 else utility.DEFAULT_ROOM
+    stats = {'id': worker_id, 'room': room, 'sent': 0, 'delivered': 0, 'latencies': [], 'nacks': 0, 'resent': 0,
+             'lead_time': None, 'failover_delivery_time': None, 'error': None}
+    probe_delivered = threading.Event()
+
+    # Wraps the functions the client calls through its globals, to record what it receives
+    original_server_command = client.server_command
+    original_request_missing = client.request_missing
+
+    def server_command(message):
+        now = time.time()
+        match message:
+            case {'command': 'CHAT', 'contents': {'chat_contents': str(contents)}} if contents.startswith(CHAT_PREFIX):
+                sender, sequence, sent = contents.split(' ', 1)[0][len(CHAT_PREFIX):].split(':')
+                if int(sequence) >= 0:
+                    stats['delivered'] += 1
+                    stats['latencies'].append(now - float(sent))
+                elif int(sender) == worker_id:
+                    probe_delivered.set()
+            case {'command': 'RESEND', 'contents': {'messages': messages}}:
+                stats['resent'] += len(messages)
+            case {'command': 'LEAD'} if control['failover'].is_set() and stats['lead_time'] is None:
+                stats['lead_time'] = now - control['kill_time'].value
+        return original_server_command(message)
+
+    def request_missing(first, last):
+        stats['nacks'] += 1
+        return original_request_missing(first, last)
+
+    client.server_command = server_command
+    client.request_missing = request_missing
+
+    def chat(sequence):
+        contents = f'{CHAT_PREFIX}{worker_id}:{sequence}:{time.time():.6f} '
+        client.message_to_server('CHAT', contents.ljust(config['size'], 'x'))
+
+    client.set_server_address(server)
+    threading.Thread(target=client.tcp_listener, daemon=True).start()
+    threading.Thread(target=client.multicast_listener, daemon=True).start()
+    threading.Thread(target=client.keep_alive, daemon=True).start()
+    time.sleep(0.6)  # The multicast listener waits 0.5 seconds before it starts listening
+    client.join_server()
+    deadline = time.monotonic() + 10
+    while client.hold_back.clock is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if room != client.room_name:
+        client.message_to_server('ROOM', room)
+        while client.room_name != room and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(ROOM_SETTLE_TIME)
+    results.put(('ready', worker_id))
+
+    control['start'].wait()
+    interval = 1 / config['rate']
+    start = time.monotonic()
+    next_send = start
+    while time.monotonic() - start < config['duration'] and client.is_active:
+        chat(stats['sent'])
+        stats['sent'] += 1
+        next_send += interval
+        time.sleep(max(0.0, next_send - time.monotonic()))
+    if not client.is_active:
+        stats['error'] = 'client shut down, the server was unreachable'
+    time.sleep(config['drain'])
+
+    # The benchmark kills the leader, then we wait to hear about the new one and time a chat sent through it
+    # Clients of the old leader also have to be handed to another server first
+    if config['failover'] and client.is_active:
+        control['failover'].wait()
+        deadline = time.monotonic() + 15
+        while (stats['lead_time'] is None or client.server_address == server) and time.monotonic() < deadline:
+            time.sleep(0.005)
+        if client.server_address != server:
+            chat(-1)
+            if probe_delivered.wait(10):
+                stats['failover_delivery_time'] = time.time() - control['kill_time'].value
+
+    client.down()
+    results.put(('done', stats))
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    return sorted_values[round(percent / 100 * (len(sorted_values) - 1))]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+# Commit latency over every server, from the summaries of their histograms
+# The mean and max are over every commit. The percentiles can't be combined, so they are those of the server
+# that committed the most
+def commit_latency(server_stats):
+    summaries = [stats['histograms'].get('replication.commit_seconds', {'count': 0}) for stats in server_stats]
+    summaries = [summary for summary in summaries if summary['count']]
+    if not summaries:
+        return None
+    commits = sum(summary['count'] for summary in summaries)
+    busiest = max(summaries, key=lambda summary: summary['count'])
+    return {
+        'commits': commits,
+        'mean': milliseconds(sum(summary['mean'] * summary['count'] for summary in summaries) / commits),
+        'p50': milliseconds(busiest['p50']),
+        'p99': milliseconds(busiest['p99']),
+        'max': milliseconds(max(summary['max'] for summary in summaries)),
+    }
+
+
+def summarize(arguments, worker_stats, elapsed, server_stats):
+    latencies = sorted(latency for stats in worker_stats for latency in stats['latencies'])
+    sent = sum(stats['sent'] for stats in worker_stats)
+    delivered = sum(stats['delivered'] for stats in worker_stats)
+    # Every chat is delivered to each client in the sender's room
+    room_sizes = {}
+    for stats in worker_stats:
+        room_sizes[stats['room']] = room_sizes.get(stats['room'], 0) + 1
+    expected = sum(stats['sent'] * room_sizes[stats['room']] for stats in worker_stats)
+    lead_times = sorted(stats['lead_time'] for stats in worker_stats if stats['lead_time'] is not None)
+    delivery_times = sorted(stats['failover_delivery_time'] for stats in worker_stats
+                            if stats['failover_delivery_time'] is not None)
+    return {
+        'config': {key: value for key, value in vars(arguments).items() if key not in ('output', 'verbose')},
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'chats_sent': sent,
+        'chats_delivered': delivered,
+        'delivery_ratio': delivered / expected if expected else None,
+        'chats_sent_per_second': sent / elapsed,
+        'deliveries_per_second': delivered / elapsed,
+        'latency_ms': {
+            'mean': milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': milliseconds(percentile(latencies, 50)),
+            'p90': milliseconds(percentile(latencies, 90)),
+            'p99': milliseconds(percentile(latencies, 99)),
+            'max': milliseconds(latencies[-1] if latencies else None),
+        },
+        'commit_ms': commit_latency(server_stats),
+        'nacks_sent': sum(stats['nacks'] for stats in worker_stats),
+        'messages_resent': sum(stats['resent'] for stats in worker_stats),
+        'failover_ms': {
+            'new_leader_announced': milliseconds(percentile(lead_times, 50)),
+            'first_delivery': milliseconds(percentile(delivery_times, 50)),
+            'clients_failed_over': len(delivery_times),
+        } if arguments.failover else None,
+        'client_errors': [stats['error'] for stats in worker_stats if stats['error']],
+        'server_stats': server_stats,
+    }
+
+
+def print_results(results):
+    print(f'Chats sent:           {results["chats_sent"]} ({results["chats_sent_per_second"]:.1f}/s)')
+    print(f'Chats delivered:      {results["chats_delivered"]} ({results["deliveries_per_second"]:.1f}/s)')
+    if results['delivery_ratio'] is not None:
+        print(f'Delivery ratio:       {results["delivery_ratio"]:.4f}')
+    print('Latency (ms):         ' + ', '.join(f'{key} {value}' for key, value in results['latency_ms'].items()))
+    if results['commit_ms']:
+        print('Commit (ms):          ' + ', '.join(f'{key} {value}' for key, value in results['commit_ms'].items()))
+    print(f'NACKs sent:           {results["nacks_sent"]}')
+    print(f'Messages resent:      {results["messages_resent"]}')
+    if results['failover_ms']:
+        print('Failover (ms):        ' + ', '.join(f'{key} {value}' for key, value in results['failover_ms'].items()))
+    for error in results['client_errors']:
+        print(f'Client error:         {error}')
+
+
+def main():
+    arguments = parse_arguments()
+    if arguments.failover and arguments.servers < 2:
+        sys.exit('--failover needs at least 2 servers')
+    # The client processes inherit this, so their client module binds to the loopback address
+    os.environ['CHATROOM_IP'] = BENCHMARK_IP
+    # Imported after setting the address, so that utility picks it up here too
+    from stats import request_stats
+
+    servers = []
+    ports = []
+    try:
+        for i in range(arguments.servers):
+            ports.append(free_port())
+            servers.append(start_server(ports[-1], arguments, join_port=ports[0] if i else None))
+            wait_for_port(ports[-1])
+            time.sleep(0.5)  # Gives a joining server time to receive the leader's state
+
+        context = multiprocessing.get_context('spawn')
+        control = {'start': context.Event(), 'failover': context.Event(), 'kill_time': context.Value('d', 0)}
+        results = context.Queue()
+        config = {'rate': arguments.rate, 'duration': arguments.duration, 'size': arguments.size,
+                  'rooms': arguments.rooms, 'drain': arguments.drain, 'failover': arguments.failover,
+                  'wire_format': arguments.wire_format}
+        workers = [context.Process(target=client_worker, args=(i, (BENCHMARK_IP, ports[0]), config, control, results))
+                   for i in range(arguments.clients)]
+        for worker in workers:
+            worker.start()
+        for _ in workers:
+            results.get(timeout=30)
+
+        print(f'Running {arguments.clients} clients against {arguments.servers} servers for {arguments.duration}s')
+        control['start'].set()
+        start = time.monotonic()
+        time.sleep(arguments.duration + arguments.drain + 0.5)
+        elapsed = time.monotonic() - start - arguments.drain - 0.5
+        server_stats = [request_stats((BENCHMARK_IP, port)) for port in ports]
+
+        if arguments.failover:
+            print('Killing the leader')
+            control['kill_time'].value = time.time()
+            servers[0].kill()
+            control['failover'].set()
+
+        worker_stats = []
+        for _ in workers:
+            kind, stats = results.get(timeout=60)
+            worker_stats.append(stats)
+        for worker in workers:
+            worker.join(timeout=5)
+    finally:
+        for server in servers:
+            server.kill()
+
+    summary = summarize(arguments, worker_stats, elapsed, server_stats)
+    print_results(summary)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(summary, output_file, indent=2, default=repr)
+        print(f'Results written to {arguments.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3.10
+
+"""
+Compares encode/decode throughput and size of the repr wire format with the binary one from codec.py,
+and of both of them compressed (see COMPRESSION in utility.py)
+
+Usage: python benchmark_codec.py [number of messages per test]
+"""
+
+import sys
+import timeit
+
+import utility
+
+SENDER = ('192.168.0.10', 51234)
+CLIENTS = [(f'192.168.1.{i % 250}', 40000 + i) for i in range(200)]
+
+# Messages like the ones the chatroom actually sends
+MESSAGES = {
+    'PING': ('PING', SENDER, '', None),
+    'CHAT (client to server)': ('CHAT', SENDER, 'Hello everyone, how is it going?', None),
+    'CHAT (multicast)': ('CHAT', SENDER, {'chat_sender': CLIENTS[0], 'chat_contents': 'Hello everyone!'}, [1234]),
+    'CHAT (sender id)': ('CHAT', SENDER, {'chat_sender': 17, 'chat_contents': 'Hello everyone!'}, [1234]),
+    'JOIN': ('JOIN', SENDER, utility.format_join_quit('client', True, CLIENTS[1]), None),
+    'STATE (200 clients)': ('STATE', SENDER, {'servers': CLIENTS[:5], 'clients': CLIENTS,
+                                              'server_clock': [10], 'client_clock': [1234],
+                                              'server_history': [], 'client_history': []}, None),
+}
+
+
+# Each format is a wire format and whether messages are compressed
+FORMATS = {'repr': ('repr', False), 'binary': ('binary', False), 'repr+z': ('repr', True), 'binary+z': ('binary', True)}
+
+
+def bench(wire_format, message, number):
+    utility.WIRE_FORMAT, utility.COMPRESSION = FORMATS[wire_format]
+    encoded = utility.encode_message(*message)
+    encode_time = timeit.timeit(lambda: utility.encode_message(*message), number=number)
+    decode_time = timeit.timeit(lambda: utility.decode_message(encoded), number=number)
+    return len(encoded), number / encode_time, number / decode_time
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f'{"message":<26}{"format":<10}{"bytes":>8}{"encode/s":>12}{"decode/s":>12}')
+    for name, message in MESSAGES.items():
+        results = {}
+        for wire_format in FORMATS:
+            size, encodes, decodes = results[wire_format] = bench(wire_format, message, number)
+            print(f'{name:<26}{wire_format:<10}{size:>8}{encodes:>12.0f}{decodes:>12.0f}')
+        print(f'{"":<26}{"speedup":<10}{"":>8}'
+              f'{results["binary"][1] / results["repr"][1]:>11.1f}x{results["binary"][2] / results["repr"][2]:>11.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3.10
+# Append-only log of multicast messages on disk, so the chat history outlives the servers
+from array import array
+from bisect import bisect_right
+import mmap
+import os
+import struct
+import threading
+
+# Every record is the first and last clock value of a message and its length, followed by the message bytes
+RECORD_HEADER = struct.Struct('!QQI')
+# An index entry is the first clock value of a record and where the record starts in its segment
+INDEX_ENTRY = struct.Struct('!QQ')
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.index'
+
+# A new segment is started once the last one holds SEGMENT_BYTES bytes
+# A record is added to the index once INDEX_INTERVAL bytes have been written since the last one that was
+SEGMENT_BYTES = 64 * 2 ** 20
+INDEX_INTERVAL = 4096
+
+
+# Messages of one multicast group, stored as the bytes they were multicast with, in clock order
+# The log is split into segment files named after the first clock value in them. Only the last one is written to
+# Each segment has a sparse index next to it, so a read starts near the clock value asked for instead of at the
+# start of the segment. Reads go through memory maps, so replaying a long history copies only the messages returned
+# Every record is flushed as soon as it is written, so a server that stops only loses what it hadn't written yet
+# With sync, every record is also flushed to the disk itself, so it survives the machine going down too
+# The record being written when a server stopped can be cut off, which is cleaned up the next time the log is opened
+class ChatLog:
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, index_interval=INDEX_INTERVAL, sync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.sync = sync
+        self.segments = []  # First clock value of every segment, oldest first
+        self.indexes = {}  # Clock values and offsets of the indexed records of each segment, as two arrays
+        self.maps = {}  # Memory maps of the segments before the last one, which never change again
+        self.last_clock = 0
+        self.file = None  # The last segment and its index, which are appended to
+        self.index_file = None
+        self.size = 0  # Size of the last segment
+        self.lock = threading.Lock()
+        self.open()
+
+    def path(self, segment, suffix):
+        return os.path.join(self.directory, f'{segment:020d}{suffix}')
+
+    # Picks up the segments already on disk, and carries on appending to the last one
+    def open(self):
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        for segment in self.segments:
+            self.indexes[segment] = self.read_index(segment)
+        while self.segments:
+            segment = self.segments[-1]
+            self.size = self.recover(segment)
+            if self.size:
+                self.file = open(self.path(segment, SEGMENT_SUFFIX), 'ab')
+                self.index_file = open(self.path(segment, INDEX_SUFFIX), 'ab')
+                return
+            # Nothing was written to the segment before the server stopped
+            for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+                if os.path.exists(self.path(segment, suffix)):
+                    os.remove(self.path(segment, suffix))
+            self.segments.pop()
+            del self.indexes[segment]
+
+    def read_index(self, segment):
+        clocks, offsets = array('Q'), array('Q')
+        path = self.path(segment, INDEX_SUFFIX)
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                data = file.read()
+            for clock, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                clocks.append(clock)
+                offsets.append(offset)
+        return clocks, offsets
+
+    # Finds the end of the last complete record in the segment and cuts off anything after it
+    # Only the records after the last index entry have to be read to find it
+    # Returns the size of what is left
+    def recover(self, segment):
+        path = self.path(segment, SEGMENT_SUFFIX)
+        clocks, offsets = self.indexes[segment]
+        size = os.path.getsize(path)
+        while offsets and offsets[-1] >= size:
+            clocks.pop()
+            offsets.pop()
+
+        offset = offsets[-1] if offsets else 0
+        with open(path, 'r+b') as file:
+            file.seek(offset)
+            while len(header := file.read(RECORD_HEADER.size)) == RECORD_HEADER.size:
+                _, last, length = RECORD_HEADER.unpack(header)
+                if offset + RECORD_HEADER.size + length > size:
+                    break
+                file.seek(length, os.SEEK_CUR)
+                offset += RECORD_HEADER.size + length
+                self.last_clock = last
+            file.truncate(offset)
+
+        with open(self.path(segment, INDEX_SUFFIX), 'wb') as file:
+            file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in zip(clocks, offsets)))
+        return offset
+
+    # Adds a message using the clock values from first to last
+    # Messages that aren't newer than the last one logged have been logged already, and are skipped
+    # Returns whether the message was added
+    def append(self, first, last, message):
+        with self.lock:
+            if last <= self.last_clock:
+                return False
+            if self.file is None or self.size >= self.segment_bytes:
+                self.start_segment(first)
+
+            clocks, offsets = self.indexes[self.segments[-1]]
+            if not offsets or self.size - offsets[-1] >= self.index_interval:
+                clocks.append(first)
+                offsets.append(self.size)
+                self.index_file.write(INDEX_ENTRY.pack(first, self.size))
+                self.index_file.flush()
+
+            self.file.write(RECORD_HEADER.pack(first, last, len(message)))
+            self.file.write(message)
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            self.size += RECORD_HEADER.size + len(message)
+            self.last_clock = last
+            return True
+
+    def start_segment(self, first):
+        if self.file is not None:
+            self.file.close()
+            self.index_file.close()
+        self.segments.append(first)
+        self.indexes[first] = (array('Q'), array('Q'))
+        self.file = open(self.path(first, SEGMENT_SUFFIX), 'ab')
+        self.index_file = open(self.path(first, INDEX_SUFFIX), 'ab')
+        self.size = 0
+
+    # Returns every logged message using a clock value from first to last, oldest first, and at most limit of them
+    # Appending carries on while the log is read, as the last segment is only read up to where it ended when the read
+    # started
+    def read(self, first, last, limit=None):
+        with self.lock:
+            if not self.segments or first > self.last_clock:
+                return []
+            start = max(bisect_right(self.segments, first) - 1, 0)
+            segments = self.segments[start:]
+            clocks, offsets = self.indexes[segments[0]]
+            i = bisect_right(clocks, first) - 1
+            offset = offsets[i] if i >= 0 else 0
+            last_segment, last_size = self.segments[-1], self.size
+
+        messages = []
+        for segment in segments:
+            if segment > last:
+                break
+            if segment == last_segment:
+                with open(self.path(segment, SEGMENT_SUFFIX), 'rb') as file, \
+                        mmap.mmap(file.fileno(), last_size, access=mmap.ACCESS_READ) as view:
+                    self.read_records(view, offset, first, last, limit, messages)
+            elif not self.read_records(self.map_segment(segment), offset, first, last, limit, messages):
+                break
+            offset = 0
+        return messages
+
+    def map_segment(self, segment):
+        with self.lock:
+            view = self.maps.get(segment)
+            if view is None:
+                with open(self.path(segment, SEGMENT_SUFFIX), 'rb') as file:
+                    view = self.maps[segment] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            return view
+
+    # Adds the messages of the records from offset on to messages
+    # Returns False once there is nothing more to read, because the records are past last or the limit is reached
+    def read_records(self, view, offset, first, last, limit, messages):
+        while offset < len(view):
+            if limit is not None and len(messages) >= limit:
+                return False
+            record_first, record_last, length = RECORD_HEADER.unpack_from(view, offset)
+            if record_first > last:
+                return False
+            offset += RECORD_HEADER.size
+            if record_last >= first:
+                messages.append(view[offset:offset + length])
+            offset += length
+        return True
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3.10
 
+import argparse
+from collections import deque
+import random
 import threading
 import sys
-from time import sleep
+from time import sleep, monotonic
 
-from utility import BUFFER_SIZE, encode_message, decode_message, format_join_quit
+from utility import encode_message, decode_message, format_join_quit
 import utility
+from history import HoldBackQueue
+from metrics import format_stats
 
 # Create TCP socket for listening to unicast messages
 # The address tuple of this socket is the unique identifier for the client
@@ -15,19 +20,68 @@ client_address = client_socket.getsockname()
 # Global variable to save the server address
 server_address = None
 
+# Every server in the chatroom, as the leader last told us with ASSIGN, to reconnect to when ours is gone
+# While reconnecting, messages for the server wait in outbox, oldest first. Once it holds OUTBOX_SIZE messages,
+# the oldest are dropped
+# Each round of trying the servers waits longer than the one before, from RECONNECT_DELAY up to RECONNECT_MAX_DELAY
+# seconds. The wait is picked at random from half of that up, so clients that lost the same server don't all come back
+# at the same moment
+known_servers = []
+outbox = deque(maxlen=1000)
+outbox_lock = threading.Lock()
+is_connected = threading.Event()
+RECONNECT_DELAY = 0.05
+RECONNECT_MAX_DELAY = 2
+
 # Flag to enable stopping the client
 is_active = True
 
 clock = [0]
 
+# The chat room we're in and its multicast group. The server tells us both with ROOM, see join_room
+room_name = utility.DEFAULT_ROOM
+room_group = utility.MG_CLIENT
+room_lock = threading.Lock()
+
+# Multicasts are printed in clock order through this. A gap is NACKed, and asked for again after NACK_RETRY seconds
+# Everything is held back until the server tells us the clock with ROOM
+# Each room has its own clock, so the queue is replaced when we move to another room
+NACK_RETRY = 0.5
+
+
+def new_hold_back(room_clock=None):
+    return HoldBackQueue(lambda message: deliver_multicast(message), lambda first, last: request_missing(first, last),
+                         clock=room_clock, retry_timeout=NACK_RETRY)
+
+
+hold_back = new_hold_back()
+
+# The server drops us once it hasn't heard from us for a while, see LEASE_TIMEOUT in server.py
+# So if we haven't sent it anything for KEEPALIVE_INTERVAL seconds, we send it an ALIVE datagram
+KEEPALIVE_INTERVAL = 1
+last_sent = [0.0]
+
+# Addresses of the clients the servers gave ids to, which chats can carry instead of the address, see SENDER_IDS
+# in server.py. A chat from an id we weren't told about is shown with the id
+sender_addresses = {}
+
+# Number of messages #HISTORY shows when it isn't given a clock value to start from
+HISTORY_SHOWN = 20
+
+# Leaves room in the multicast datagram for the rest of the encoded message
+MAX_CHAT_SIZE = utility.MAX_DATAGRAM_SIZE - utility.BUFFER_SIZE
+
 
 def main():
     utility.cls()
-    broadcast_for_server()
+    if server_address is None:  # The server can also be given on the command line
+        broadcast_for_server()
+    join_server()
 
     threading.Thread(target=transmit_messages).start()
     threading.Thread(target=tcp_listener).start()
     threading.Thread(target=multicast_listener).start()
+    threading.Thread(target=keep_alive).start()
 
 
 # Broadcasts that this client is looking for a server
@@ -51,6 +105,10 @@ def broadcast_for_server():
                 break
 
     broadcast_socket.close()
+
+
+def join_server():
+    is_connected.set()
     message_to_server('JOIN', format_join_quit('client', True, client_address))
 
 
@@ -58,6 +116,8 @@ def broadcast_for_server():
 def set_server_address(address: tuple):
     global server_address
     server_address = address
+    if address not in known_servers:
+        known_servers.append(address)
 
 
 # Function to handle sending messages to the server
@@ -75,7 +135,8 @@ def transmit_messages():
             sys.exit(0)
 
         # Send message
-        if len(message) > BUFFER_SIZE / 10:
+        # Tcp messages can be any length, but the chat is multicast to the other clients in a single datagram
+        if len(message.encode()) > MAX_CHAT_SIZE:
             print('Message is too long')
         elif len(message) == 0:
             continue
@@ -85,7 +146,8 @@ def transmit_messages():
             message_to_server('CHAT', message)
 
 
-# Function to handle receiving tcp messages from the server
+# Function to handle tcp connections from the server
+# Servers keep their connections open, so each one gets its own thread to read messages from
 def tcp_listener():
     client_socket.settimeout(2)
     while is_active:
@@ -94,57 +156,155 @@ def tcp_listener():
         except TimeoutError:
             pass
         else:
-            message = decode_message(client.recv(BUFFER_SIZE))
-            server_command(message)
+            threading.Thread(target=tcp_connection_handler, args=(client,)).start()
 
     client_socket.close()
+    utility.close_tcp_connections()
     sys.exit(0)
 
 
-# Function to listen for messages multicasted to the client multicast group
+# Function to handle receiving tcp messages from the server over one connection
+def tcp_connection_handler(connection):
+    for data in utility.receive_tcp_messages(connection, lambda: is_active):
+        server_command(decode_message(data))
+
+
+# Function to listen for messages multicasted to our room's group
+# When we move to another room, the socket is swapped for one on the new group
+# Anything multicast to the new room before that is resent by the server, since we didn't ack it
 def multicast_listener():
     sleep(0.5)
-    # Create the socket
-    m_listener_socket = utility.setup_multicast_listener_socket(utility.MG_CLIENT)
-    m_listener_socket.settimeout(2)
+    m_listener_socket = None
+    listening_room = None
 
     while is_active:
+        if listening_room != room_name:
+            if m_listener_socket:
+                m_listener_socket.close()
+            with room_lock:
+                listening_room, group = room_name, room_group
+            # Create the socket
+            m_listener_socket = utility.setup_multicast_listener_socket(group)
+            m_listener_socket.settimeout(NACK_RETRY)
         try:
-            data, address = m_listener_socket.recvfrom(BUFFER_SIZE)
+            data, address = m_listener_socket.recvfrom(utility.MAX_DATAGRAM_SIZE)
         except TimeoutError:
-            pass
+            hold_back.check_gap()
         else:
             message = decode_message(data)
-            m_listener_socket.sendto(b'ack', address)
+            m_listener_socket.sendto(encode_message('ACK', client_address, listening_room, message['clock']), address)
+            hold_back_multicast(message, listening_room)
+
+    m_listener_socket.close()
+    sys.exit(0)
 
-            clock[0] += 1
-            if clock[0] < message['clock'][0]:
-                for i in range(clock[0], message['clock'][0]):
-                    message_to_server('MSG', {'list': 'client', 'clock': [i]})
-                    clock[0] += 1
-                # This sleep allows the server time to send the missing messages
-                sleep(0.5)
 
-            if clock[0] != message['clock'][0]:
-                raise ValueError(f'Clock is not correct, {clock =}')
-            server_command(message)
+# Passes every message to the hold back queue, which prints them in clock order
+# A BATCH holds several chats and uses up one clock value for each
+# Messages for a room we've already left are dropped
+def hold_back_multicast(message, room):
+    with room_lock:
+        if room != room_name:
+            return
+        for unpacked in utility.unpack_multicast(message):
+            hold_back.receive(unpacked['clock'][0], unpacked)
 
-    m_listener_socket.close()
+
+def deliver_multicast(message):
+    clock[0] = message['clock'][0]
+    server_command(message)
+
+
+# Renews our lease with the server while we aren't sending it anything else
+def keep_alive():
+    keepalive_socket = utility.setup_udp_sender_socket()
+    while is_active:
+        if server_address and monotonic() - last_sent[0] >= KEEPALIVE_INTERVAL:
+            keepalive_socket.sendto(encode_message('ALIVE', client_address), server_address)
+            last_sent[0] = monotonic()
+        sleep(KEEPALIVE_INTERVAL / 4)
+
+    keepalive_socket.close()
     sys.exit(0)
 
 
+# Asks the server for every message in a gap with one NACK
+def request_missing(first, last):
+    message_to_server('NACK', {'list': room_name, 'clock': [first, last]})
+
+
 # Sends a message to the server
-# If no server is there, shutdown
+# If the server can't be reached, the message waits in the outbox while we reconnect to a server, see reconnect
+# NACKs aren't kept, as the hold back queue asks for anything still missing again
 def message_to_server(command, contents):
-    message_bytes = encode_message(command, client_address, contents)
+    with outbox_lock:
+        if not is_connected.is_set():
+            if command != 'NACK':
+                outbox.append((command, contents))
+            return
     try:
-        utility.tcp_transmit_message(message_bytes, server_address)
+        send_to_server(command, contents, server_address)
     except (ConnectionRefusedError, TimeoutError):
-        # print('\rError sending message, searching for server again')
-        # broadcast_for_server()
-        print('\rError sending message, server is unreachable')
-        down()
-        print('\rProgram is shutting down.')
+        with outbox_lock:
+            if command != 'NACK':
+                outbox.append((command, contents))
+            if not is_connected.is_set():
+                return
+            is_connected.clear()
+        print('\rLost the connection to the server, reconnecting')
+        threading.Thread(target=reconnect, args=(server_address,)).start()
+
+
+def send_to_server(command, contents, address):
+    utility.tcp_transmit_message(encode_message(command, client_address, contents), address)
+    last_sent[0] = monotonic()
+
+
+# Tries every server we know of, until one of them takes a JOIN
+# The JOIN tells the leader we are back, along with our room and the server we lost. If the chatroom still has us,
+# we are only told which server to use, with ASSIGN. Otherwise we join again and are put back in the room
+# Then the outbox is sent, and we ask for every message of the room after the last one we delivered, which goes
+# through the hold back queue like messages we NACKed
+def reconnect(lost_server):
+    delay = RECONNECT_DELAY
+    while is_active:
+        # A server the leader told us about since is tried first, and the one we lost last
+        candidates = [address for address in known_servers if address not in (server_address, lost_server)]
+        random.shuffle(candidates)
+        if server_address != lost_server:
+            candidates.insert(0, server_address)
+        for address in [*candidates, lost_server]:
+            try:
+                send_to_server('JOIN', rejoin_contents(lost_server), address)
+            except (ConnectionRefusedError, TimeoutError):
+                continue
+            # An ASSIGN that arrived in the meantime already told us which server to use
+            if server_address == lost_server:
+                set_server_address(address)
+            print(f'\rReconnected to {address[0]}')
+            resume()
+            return
+        sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+def rejoin_contents(lost_server):
+    return format_join_quit('client', True, client_address) | {'room': room_name, 'lost_server': lost_server}
+
+
+def resume():
+    with outbox_lock:
+        while outbox:
+            command, contents = outbox[0]
+            try:
+                send_to_server(command, contents, server_address)
+            except (ConnectionRefusedError, TimeoutError):
+                threading.Thread(target=reconnect, args=(server_address,)).start()
+                return
+            outbox.popleft()
+        is_connected.set()
+    if clock[0]:
+        message_to_server('HISTORY', {'list': room_name, 'clock': clock[0] + 1, 'resume': True})
 
 
 # Handle commands entered by this client
@@ -156,6 +316,18 @@ def client_command(message):
             message_to_server('QUIT', format_join_quit('client', True, client_address))
             down()
             print('\rGoodbye!')
+        case ['#JOIN', *room]:
+            message_to_server('ROOM', '_'.join(room))
+        case ['#LEAVE']:
+            message_to_server('ROOM', utility.DEFAULT_ROOM)
+        # The last HISTORY_SHOWN messages of the room, or every message from a clock value on
+        # The server sends a limited number of messages at a time, so a long history is read in several goes
+        case ['#HISTORY']:
+            message_to_server('HISTORY', {'list': room_name, 'clock': max(clock[0] - HISTORY_SHOWN + 1, 1)})
+        case ['#HISTORY', first] if first.isdigit():
+            message_to_server('HISTORY', {'list': room_name, 'clock': int(first)})
+        case ['#STATS']:
+            message_to_server('STATS', '')
         case ['#DOWN', '0']:
             message_to_server('DOWN', False)
         case ['#DOWN']:
@@ -165,7 +337,8 @@ def client_command(message):
 # Handle commands received by this client from the server
 def server_command(message):
     match message:
-        case {'command': 'CHAT', 'contents': {'chat_sender': address, 'chat_contents': chat_contents}}:
+        case {'command': 'CHAT', 'contents': {'chat_sender': sender, 'chat_contents': chat_contents}}:
+            address = sender_addresses.get(sender, (f'client {sender}', 0)) if type(sender) is int else sender
             if address != client_address:
                 print(f'\r{address[0]}: {chat_contents}')
                 print('\rYou: ' if is_active else '', end='')
@@ -175,20 +348,76 @@ def server_command(message):
         case {'command': 'SERV'}:
             print(f'\r{message["contents"]}')
             print('\rYou: ' if is_active else '', end='')
-        case {'command': 'LEAD', 'sender': address}:
-            set_server_address(address)
-        case {'command': 'CLOCK', 'contents': client_clock}:
-            global clock
-            clock[0] = client_clock[0]
+        # The server's reply to #STATS
+        case {'command': 'STATS', 'contents': stats}:
+            for line in format_stats(stats):
+                print(f'\r{line}')
+            print('\rYou: ' if is_active else '', end='')
+        # The server we should talk to from now on, picked by the leader, and the servers to try if it is gone
+        case {'command': 'ASSIGN', 'contents': {'server': address, 'servers': servers, 'id': sender_id}}:
+            known_servers[:] = [tuple(server) for server in servers]
+            set_server_address(tuple(address))
+            if sender_id is not None:
+                sender_addresses[sender_id] = client_address
+        # The id of a client that joined, which its chats carry
+        case {'command': 'JOIN', 'contents': {'address': address, 'id': sender_id}}:
+            sender_addresses[sender_id] = tuple(address)
+        case {'command': 'ROOM', 'contents': {'room': room, 'group': group, 'clock': room_clock}}:
+            sender_addresses.update((sender_id, tuple(address))
+                                    for sender_id, address in message['contents'].get('senders', {}).items())
+            join_room(room, tuple(group), room_clock[0])
+            print(f'\rYou are in room {room}')
+            print('\rYou: ' if is_active else '', end='')
+        # The messages we NACKed. They go through the hold back queue just like multicasts
+        case {'command': 'RESEND', 'contents': {'list': room, 'messages': messages}}:
+            for data in messages:
+                hold_back_multicast(decode_message(data), room)
+        # The server's reply to #HISTORY. Only the chats and server messages are printed
+        case {'command': 'HISTORY', 'contents': {'list': room, 'messages': messages}}:
+            print(f'\rHistory of room {room}:')
+            for data in messages:
+                for unpacked in utility.unpack_multicast(decode_message(data)):
+                    if unpacked['command'] in ('CHAT', 'SERV'):
+                        server_command(unpacked)
+            print('\rYou: ' if is_active else '', end='')
         case {'command': 'DOWN'}:
             down()
             print('\rProgram is shutting down, press enter to exit.', end='')
 
 
+# Starts following the room's clock. The multicast listener picks up the new group on its own
+# Staying in the same room only sets the clock if we don't have one yet, so nothing already held back is lost,
+# and a client that was put back in its room after reconnecting can still ask for what it missed
+def join_room(room, group, room_clock):
+    global room_name, room_group, hold_back
+    with room_lock:
+        if room == room_name:
+            if hold_back.clock is None:
+                clock[0] = room_clock
+                hold_back.set_clock(room_clock)
+        else:
+            clock[0] = room_clock
+            room_name, room_group = room, group
+            hold_back = new_hold_back(room_clock)
+
+
 def down():
     global is_active
     is_active = False
 
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Chatroom client')
+    parser.add_argument('--server', metavar='IP:PORT', help='join the server at this address without broadcasting')
+    parser.add_argument('--wire-format', choices=('repr', 'binary'), default=utility.WIRE_FORMAT)
+    parser.add_argument('--compress', action='store_true', help='compress messages with a dictionary of common ones')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.server:
+        set_server_address(utility.parse_address(arguments.server))
+    utility.WIRE_FORMAT = arguments.wire_format
+    utility.COMPRESSION = arguments.compress
     main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3.10
+# Compact binary wire format for messages
+# This does the same job as repr() / ast.literal_eval in utility.py without running the Python parser on every packet
+#
+# Layout of a message:
+#   magic (1 byte) | command id (1 byte) | flags (1 byte)
+#   [sender ip (4 bytes) | sender port (2 bytes)]         if the message has a sender
+#   [clock length (1 byte) | clock values (8 bytes each)] if the message has a clock
+#   contents length (4 bytes) | contents
+#
+# The contents are encoded with a one byte type tag in front of each value
+# Only the types that messages actually contain are supported: None, bool, int, float, str, bytes, tuple, list and dict
+# Small non-negative ints get a shorter encoding of their own
+import socket
+import struct
+
+# First byte of every binary message. repr() of a dict always starts with '{', so the two formats can't be confused
+MAGIC = 0xB1
+
+# Commands get a one byte id. Command id 0 means the command name is sent as a string in front of the contents
+COMMANDS = ('CHAT', 'JOIN', 'QUIT', 'STATE', 'VOTE', 'NACK', 'DOWN', 'PING', 'SERV', 'LEAD', 'CLOCK', 'BATCH', 'ACK', 'RESEND',
+            'PONG', 'STATS', 'ROOM', 'ROUTE', 'OWNER', 'ASSIGN', 'HISTORY',
+            'ALIVE', 'SYNC')
+COMMAND_IDS = {command: i for i, command in enumerate(COMMANDS, 1)}
+
+# Flags for the optional parts of the header
+HAS_SENDER = 1
+HAS_CLOCK = 2
+
+HEADER = struct.Struct('!BBB')
+ADDRESS = struct.Struct('!4sH')
+COUNT = struct.Struct('!I')
+CLOCK_LENGTH = struct.Struct('!B')
+INT = struct.Struct('!q')
+SHORT = struct.Struct('!H')
+FLOAT = struct.Struct('!d')
+
+# Type tags for the contents
+NONE = ord('N')
+TRUE = ord('T')
+FALSE = ord('F')
+INT_TAG = ord('i')
+SHORT_INT = ord('h')  # Ints from 0 to 65535, like ports and sender ids, in 2 bytes
+BIG_INT = ord('I')  # Ints that don't fit in 8 bytes are sent as their decimal string
+FLOAT_TAG = ord('f')
+STR = ord('s')
+BYTES = ord('b')
+TUPLE = ord('t')
+LIST = ord('l')
+DICT = ord('d')
+ADDRESS_TAG = ord('a')  # An (ipv4, port) tuple, which is what every node address is
+
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+# Encoded type tags, so they don't have to be built for every value
+NONE_PREFIX = bytes((NONE,))
+TRUE_PREFIX = bytes((TRUE,))
+FALSE_PREFIX = bytes((FALSE,))
+INT_PREFIX = bytes((INT_TAG,))
+SHORT_INT_PREFIX = bytes((SHORT_INT,))
+BIG_INT_PREFIX = bytes((BIG_INT,))
+FLOAT_PREFIX = bytes((FLOAT_TAG,))
+STR_PREFIX = bytes((STR,))
+BYTES_PREFIX = bytes((BYTES,))
+TUPLE_PREFIX = bytes((TUPLE,))
+LIST_PREFIX = bytes((LIST,))
+DICT_PREFIX = bytes((DICT,))
+ADDRESS_PREFIX = bytes((ADDRESS_TAG,))
+
+# Packed form of every ip address seen so far, or None for strings that aren't ip addresses
+# There are only ever a handful of hosts in a chatroom, so this stays small
+packed_ips = {}
+
+
+def is_binary(message):
+    return len(message) > 0 and message[0] == MAGIC
+
+
+def encode(command, sender, contents, clock):
+    parts = []
+    command_id = COMMAND_IDS.get(command, 0)
+    flags = (HAS_SENDER if sender is not None else 0) | (HAS_CLOCK if clock is not None else 0)
+    parts.append(HEADER.pack(MAGIC, command_id, flags))
+    if sender is not None:
+        parts.append(ADDRESS.pack(pack_ip(sender[0]) or socket.inet_aton(sender[0]), sender[1]))
+    if clock is not None:
+        parts.append(CLOCK_LENGTH.pack(len(clock)))
+        parts.append(struct.pack(f'!{len(clock)}q', *clock))
+
+    body = []
+    if not command_id:
+        encode_value(command, body)
+    encode_value(contents, body)
+    body = b''.join(body)
+    parts.append(COUNT.pack(len(body)))
+    parts.append(body)
+    return b''.join(parts)
+
+
+def decode(message):
+    magic, command_id, flags = HEADER.unpack_from(message, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a binary message')
+    index = HEADER.size
+
+    sender = None
+    if flags & HAS_SENDER:
+        ip, port = ADDRESS.unpack_from(message, index)
+        sender = (socket.inet_ntoa(ip), port)
+        index += ADDRESS.size
+
+    clock = None
+    if flags & HAS_CLOCK:
+        length = message[index]
+        clock = list(struct.unpack_from(f'!{length}q', message, index + 1))
+        index += 1 + 8 * length
+
+    body_length = COUNT.unpack_from(message, index)[0]
+    index += COUNT.size
+    if index + body_length != len(message):
+        raise ValueError('Message length does not match its header')
+
+    if command_id:
+        command = COMMANDS[command_id - 1]
+    else:
+        command, index = decode_value(message, index)
+    contents, index = decode_value(message, index)
+    return {'command': command, 'sender': sender, 'contents': contents, 'clock': clock}
+
+
+def pack_ip(ip):
+    if ip not in packed_ips:
+        try:
+            packed = socket.inet_aton(ip)
+        except OSError:
+            packed = None
+        # inet_aton also accepts short forms like '127.1', which wouldn't decode back to the same string
+        if packed is not None and socket.inet_ntoa(packed) != ip:
+            packed = None
+        packed_ips[ip] = packed
+    return packed_ips[ip]
+
+
+# Appends the encoded value to parts
+def encode_value(value, parts):
+    # Checked by exact type, so that bools aren't encoded as ints and so on
+    value_type = type(value)
+    if value_type is str:
+        data = value.encode()
+        parts.append(STR_PREFIX + COUNT.pack(len(data)))
+        parts.append(data)
+    elif value_type is int:
+        if 0 <= value <= 0xFFFF:
+            parts.append(SHORT_INT_PREFIX + SHORT.pack(value))
+        elif INT_MIN <= value <= INT_MAX:
+            parts.append(INT_PREFIX + INT.pack(value))
+        else:
+            data = str(value).encode()
+            parts.append(BIG_INT_PREFIX + COUNT.pack(len(data)))
+            parts.append(data)
+    elif value_type is tuple:
+        if len(value) == 2 and type(value[0]) is str and type(value[1]) is int and 0 <= value[1] <= 0xFFFF:
+            ip = pack_ip(value[0])
+            if ip is not None:
+                parts.append(ADDRESS_PREFIX + ADDRESS.pack(ip, value[1]))
+                return
+        parts.append(TUPLE_PREFIX + COUNT.pack(len(value)))
+        for item in value:
+            encode_value(item, parts)
+    elif value_type is dict:
+        parts.append(DICT_PREFIX + COUNT.pack(len(value)))
+        for key, item in value.items():
+            encode_value(key, parts)
+            encode_value(item, parts)
+    elif value_type is list:
+        parts.append(LIST_PREFIX + COUNT.pack(len(value)))
+        for item in value:
+            encode_value(item, parts)
+    elif value is None:
+        parts.append(NONE_PREFIX)
+    elif value is True:
+        parts.append(TRUE_PREFIX)
+    elif value is False:
+        parts.append(FALSE_PREFIX)
+    elif value_type in (bytes, bytearray):
+        parts.append(BYTES_PREFIX + COUNT.pack(len(value)))
+        parts.append(bytes(value))
+    elif value_type is float:
+        parts.append(FLOAT_PREFIX + FLOAT.pack(value))
+    else:
+        raise TypeError(f'Can not encode value of type {value_type.__name__}')
+
+
+# Returns the decoded value and the index after it
+def decode_value(message, index):
+    tag = message[index]
+    index += 1
+    if tag == STR:
+        length = COUNT.unpack_from(message, index)[0]
+        index += COUNT.size
+        return message[index:index + length].decode(), index + length
+    elif tag == INT_TAG:
+        return INT.unpack_from(message, index)[0], index + INT.size
+    elif tag == SHORT_INT:
+        return SHORT.unpack_from(message, index)[0], index + SHORT.size
+    elif tag == ADDRESS_TAG:
+        ip, port = ADDRESS.unpack_from(message, index)
+        return (socket.inet_ntoa(ip), port), index + ADDRESS.size
+    elif tag == DICT:
+        length = COUNT.unpack_from(message, index)[0]
+        index += COUNT.size
+        value = {}
+        for _ in range(length):
+            key, index = decode_value(message, index)
+            value[key], index = decode_value(message, index)
+        return value, index
+    elif tag == LIST or tag == TUPLE:
+        length = COUNT.unpack_from(message, index)[0]
+        index += COUNT.size
+        value = []
+        for _ in range(length):
+            item, index = decode_value(message, index)
+            value.append(item)
+        return (value if tag == LIST else tuple(value)), index
+    elif tag == NONE:
+        return None, index
+    elif tag == TRUE:
+        return True, index
+    elif tag == FALSE:
+        return False, index
+    elif tag == BYTES:
+        length = COUNT.unpack_from(message, index)[0]
+        index += COUNT.size
+        return bytes(message[index:index + length]), index + length
+    elif tag == BIG_INT:
+        length = COUNT.unpack_from(message, index)[0]
+        index += COUNT.size
+        return int(bytes(message[index:index + length])), index + length
+    elif tag == FLOAT_TAG:
+        return FLOAT.unpack_from(message, index)[0], index + FLOAT.size
+    raise ValueError(f'Unknown type tag {tag} at index {index - 1}')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3.10
+# Phi accrual failure detector, used by the servers to watch their neighbor in the ring
+# Based on Hayashibara et al., "The phi accrual failure detector", and the approximation used by Akka
+from collections import deque
+import math
+import threading
+from time import monotonic
+
+
+# Rather than counting missed heartbeats, this keeps the time between the last window heartbeats from each peer
+# and works out how unlikely it is that the next one is still on its way, given how long it has been
+# That is phi: the peer is this many powers of ten less likely to be alive. 1 means a 10% chance of being wrong when
+# taking the peer for dead, 8 means a chance of 1 in 100 million
+# A peer whose heartbeats come irregularly gets more time before phi goes up, and one on a quiet network less
+# The standard deviation is never taken to be below min_std_deviation, and acceptable_pause seconds are added to the
+# mean, so a few very regular heartbeats don't make a short pause look like a failure
+# Until a peer has sent a few heartbeats, they are taken to come every first_interval seconds
+class PhiAccrualDetector:
+    def __init__(self, first_interval, window=100, min_std_deviation=0.1, acceptable_pause=0.0):
+        self.first_interval = first_interval
+        self.window = window
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    # Starts watching a peer as if a heartbeat had just arrived from it
+    def new_peer(self, now):
+        spread = self.first_interval / 4
+        intervals = deque((self.first_interval - spread, self.first_interval + spread), maxlen=self.window)
+        return {'last': now, 'intervals': intervals, 'total': sum(intervals),
+                'squares': sum(interval ** 2 for interval in intervals)}
+
+    # Records a heartbeat from the peer. Returns the time since the last one, or None if it is the first
+    def heartbeat(self, peer, now=None):
+        now = monotonic() if now is None else now
+        with self.lock:
+            state = self.peers.get(peer)
+            if state is None:
+                self.peers[peer] = self.new_peer(now)
+                return None
+            interval = now - state['last']
+            state['last'] = now
+            intervals = state['intervals']
+            if len(intervals) == intervals.maxlen:
+                dropped = intervals.popleft()
+                state['total'] -= dropped
+                state['squares'] -= dropped ** 2
+            intervals.append(interval)
+            state['total'] += interval
+            state['squares'] += interval ** 2
+            return interval
+
+    # A peer that hasn't been watched yet starts being watched now, with a phi of 0
+    def phi(self, peer, now=None):
+        now = monotonic() if now is None else now
+        with self.lock:
+            state = self.peers.get(peer)
+            if state is None:
+                self.peers[peer] = self.new_peer(now)
+                return 0.0
+            count = len(state['intervals'])
+            mean = state['total'] / count
+            variance = max(state['squares'] / count - mean ** 2, 0.0)
+            elapsed = now - state['last']
+
+        std_deviation = max(math.sqrt(variance), self.min_std_deviation)
+        mean += self.acceptable_pause
+        # Logistic approximation of the normal distribution, clamped so that exp can't overflow
+        y = min(max((elapsed - mean) / std_deviation, -10.0), 10.0)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > mean:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    # Forgets a peer, so that watching it again starts afresh
+    def remove(self, peer):
+        with self.lock:
+            self.peers.pop(peer, None)
+
+    # The phi of every peer being watched
+    def suspicion(self):
+        with self.lock:
+            peers = list(self.peers)
+        return {peer: self.phi(peer) for peer in peers}
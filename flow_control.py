@@ -0,0 +1,62 @@
+#!/usr/bin/env python3.10
+# Limits on how much work a single slow or misbehaving client can make a server do
+import threading
+from time import monotonic
+
+
+# Token bucket for each key, like the address of a client
+# Every key can do rate things per second, and up to burst of them at once after being quiet
+# Keys whose bucket has filled up again are forgotten once there are more than max_keys of them,
+# so clients that come and go don't pile up
+class RateLimiter:
+    def __init__(self, rate, burst, max_keys=4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}  # Tokens left for each key, and when they were counted
+        self.lock = threading.Lock()
+
+    # Takes cost tokens from the key's bucket. Returns False, and takes nothing, if there aren't enough
+    def allow(self, key, cost=1, now=None):
+        now = monotonic() if now is None else now
+        with self.lock:
+            tokens, counted = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - counted) * self.rate)
+            is_allowed = tokens >= cost
+            self.buckets[key] = (tokens - cost if is_allowed else tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.forget_full(now)
+            return is_allowed
+
+    def forget_full(self, now):
+        full = [key for key, (tokens, counted) in self.buckets.items()
+                if tokens + (now - counted) * self.rate >= self.burst]
+        for key in full:
+            del self.buckets[key]
+
+
+# Number of sends to each destination that haven't finished yet, which is kept to at most size
+# A destination that doesn't read what it is sent can then only hold up size senders, however much it is sent
+class SendWindows:
+    def __init__(self, size):
+        self.size = size
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    # Returns False if the destination's window is full, otherwise the send has to be released when it is done
+    def acquire(self, destination):
+        with self.lock:
+            count = self.in_flight.get(destination, 0)
+            if count >= self.size:
+                return False
+            self.in_flight[destination] = count + 1
+            return True
+
+    def release(self, destination):
+        with self.lock:
+            count = self.in_flight.pop(destination, 0) - 1
+            if count > 0:
+                self.in_flight[destination] = count
+
+    def __len__(self):
+        return sum(self.in_flight.values())
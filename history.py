@@ -0,0 +1,134 @@
+#!/usr/bin/env python3.10
+# History of multicasted messages, used to resend messages that a node missed
+from array import array
+from time import monotonic
+import threading
+
+
+# Fixed size ring buffer of messages, indexed by clock value
+# Messages are stored as the bytes they were multicast with, so storing one copies nothing,
+# and resending one doesn't have to encode it again
+# A BATCH uses one clock value per chat, so the same bytes are stored in the slot of every clock in its range
+# Once the buffer is full, each new message replaces the one from depth clock values earlier
+class MessageHistory:
+    def __init__(self, depth):
+        self.depth = depth
+        self.clocks = array('q', bytes(8 * depth))  # Clock value of the message in each slot, 0 if the slot is empty
+        self.messages = [None] * depth
+        self.last_clock = 0
+        self.lock = threading.Lock()
+
+    def add(self, clock, message):
+        slot = clock % self.depth
+        with self.lock:
+            self.clocks[slot] = clock
+            self.messages[slot] = message
+            self.last_clock = max(self.last_clock, clock)
+
+    def add_range(self, first, last, message):
+        for clock in range(first, last + 1):
+            self.add(clock, message)
+
+    # Returns the message with the clock value, or None if we don't have it (anymore)
+    def get(self, clock):
+        slot = clock % self.depth
+        with self.lock:
+            return self.messages[slot] if self.clocks[slot] == clock and clock > 0 else None
+
+    # Returns every message we still have with a clock value from first to last, oldest first
+    # A message covering several clock values is only returned once
+    def get_range(self, first, last):
+        first = max(first, self.last_clock - self.depth + 1, 1)
+        messages = []
+        for clock in range(first, last + 1):
+            message = self.get(clock)
+            if message is not None and (not messages or messages[-1] is not message):
+                messages.append(message)
+        return messages
+
+    # The whole history as [first clock, last clock, message] entries, oldest first
+    # Used to hand the history to another server
+    def entries(self):
+        with self.lock:
+            stored = sorted((clock, slot) for slot, clock in enumerate(self.clocks) if clock)
+            entries = []
+            for clock, slot in stored:
+                message = self.messages[slot]
+                if entries and entries[-1][2] is message and entries[-1][1] == clock - 1:
+                    entries[-1][1] = clock
+                else:
+                    entries.append([clock, clock, message])
+        return entries
+
+    def load(self, entries):
+        with self.lock:
+            self.clocks = array('q', bytes(8 * self.depth))
+            self.messages = [None] * self.depth
+            self.last_clock = 0
+        for first, last, message in entries:
+            self.add_range(first, last, message)
+
+
+# Delivers multicast messages in clock order, exactly once each
+# Messages that arrive after a gap are held back until the missing ones have been resent
+# request is called with the first and last clock value of a gap, so they can be asked for (NACKed) in one go
+# A gap is requested again if it hasn't been filled after retry_timeout seconds
+# Until the starting clock is known (set_clock), everything is held back and nothing is requested
+class HoldBackQueue:
+    def __init__(self, deliver, request, clock=None, retry_timeout=0.5):
+        self.deliver = deliver
+        self.request = request
+        self.retry_timeout = retry_timeout
+        self.next_clock = None if clock is None else clock + 1
+        self.held = {}
+        self.requested = None  # The last gap requested, and when
+        self.lock = threading.RLock()
+
+    # Clock value of the last message delivered
+    @property
+    def clock(self):
+        return None if self.next_clock is None else self.next_clock - 1
+
+    # Returns False if the message has already been delivered
+    def receive(self, clock, message):
+        with self.lock:
+            if self.next_clock is not None and clock < self.next_clock:
+                return False
+            self.held[clock] = message
+            self.deliver_held()
+            return True
+
+    def set_clock(self, clock):
+        with self.lock:
+            self.next_clock = clock + 1
+            for held_clock in [c for c in self.held if c <= clock]:
+                del self.held[held_clock]
+            self.deliver_held()
+
+    # Delivers everything held back in clock order, skipping over any gaps
+    # Used when the messages in the gaps can't be asked for anymore
+    def flush(self):
+        with self.lock:
+            for clock in sorted(self.held):
+                self.next_clock = clock + 1
+                self.deliver(self.held.pop(clock))
+
+    def deliver_held(self):
+        if self.next_clock is None:
+            return
+        while self.next_clock in self.held:
+            message = self.held.pop(self.next_clock)
+            self.next_clock += 1
+            self.deliver(message)
+        self.check_gap()
+
+    # Requests the messages between the last delivered one and the first held back one
+    def check_gap(self):
+        with self.lock:
+            if self.next_clock is None or not self.held:
+                return
+            gap = (self.next_clock, min(self.held) - 1)
+            if self.requested and self.requested[0] == gap and monotonic() - self.requested[1] < self.retry_timeout:
+                return
+            self.requested = (gap, monotonic())
+        self.request(*gap)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3.10
+# Registry of the members of the chatroom, used for the lists of servers and clients
+from bisect import bisect_right, insort
+from time import monotonic
+import threading
+
+
+# Members are kept in a dict keyed by address, so looking one up, adding it or removing it doesn't depend on how many
+# there are. Each member has a dict of metadata, like the server that owns a client or the room it is in,
+# and when it was last heard from
+# The addresses are also kept sorted, which arranges the members in a ring. The member after an address in the ring
+# is found with a binary search, and adding or removing one only moves the addresses after it rather than sorting
+# Iterating goes over a copy of the members, so they can be added and removed by other threads at the same time
+class Membership:
+    def __init__(self, members=()):
+        self.members = {}
+        self.ring = []
+        self.lock = threading.RLock()
+        self.replace(members)
+
+    def __contains__(self, address):
+        return address in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.members))
+
+    # Returns False if the address was already a member, in which case only the metadata is updated
+    def add(self, address, **metadata):
+        address = tuple(address)
+        with self.lock:
+            member = self.members.get(address)
+            if member is not None:
+                member.update(metadata)
+                return False
+            self.members[address] = {'last_seen': monotonic()} | metadata
+            insort(self.ring, address)
+            return True
+
+    # Returns False if the address wasn't a member
+    def remove(self, address):
+        with self.lock:
+            if self.members.pop(address, None) is None:
+                return False
+            del self.ring[bisect_right(self.ring, address) - 1]
+            return True
+
+    # Replaces every member with the addresses given, which start out without metadata
+    def replace(self, addresses):
+        with self.lock:
+            self.members = {}
+            self.ring = []
+            for address in addresses:
+                self.add(address)
+
+    def get(self, address, key, default=None):
+        member = self.members.get(address)
+        return default if member is None else member.get(key, default)
+
+    # Sets metadata of a member. Addresses that aren't members are ignored
+    def set(self, address, **metadata):
+        with self.lock:
+            member = self.members.get(address)
+            if member is not None:
+                member.update(metadata)
+
+    # Records that the member was heard from just now. Returns False if the address isn't a member
+    def touch(self, address):
+        member = self.members.get(address)
+        if member is None:
+            return False
+        member['last_seen'] = monotonic()
+        return True
+
+    # The address and the value of key of every member that has a value for it
+    def items(self, key):
+        with self.lock:
+            return [(address, member[key]) for address, member in self.members.items() if member.get(key) is not None]
+
+    def values(self, key):
+        return [value for _, value in self.items(key)]
+
+    # The member after the address in the ring, wrapping around from the highest address to the lowest
+    # Returns None if there is no other member
+    def next_after(self, address):
+        with self.lock:
+            others = len(self.ring) - (address in self.members)
+            if not others:
+                return None
+            return self.ring[bisect_right(self.ring, address) % len(self.ring)]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3.10
+# Counters, latency histograms and gauges for a node, which can be read while it runs with a STATS command
+# Every module records into the one registry below, so a node's stats are all in one place
+from bisect import bisect_left
+import threading
+
+# Upper bounds of the histogram buckets in seconds, doubling from 10 microseconds to about 80 seconds
+# Anything slower goes in one last bucket
+BUCKET_BOUNDS = tuple(0.00001 * 2 ** i for i in range(24))
+
+
+# Counts of values in fixed, exponentially growing buckets
+# Recording a value is a bisect and an increment, and the memory used doesn't grow with the number of values
+# Percentiles are estimated as the upper bound of the bucket they fall in, so they are within a factor of 2
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        target = percent / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and count:
+                return min(BUCKET_BOUNDS[i], self.max) if i < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count, 'p50': self.percentile(50),
+                'p90': self.percentile(90), 'p99': self.percentile(99), 'max': self.max}
+
+
+# Gauges are functions that are called when the stats are read, for values like queue lengths
+# that are cheaper to look up than to keep track of
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Records a value, usually a duration in seconds
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    # Everything recorded so far, as plain dicts that can be sent in a message
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.summary() for name, histogram in self.histograms.items()}
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception as e:  # A gauge shouldn't stop the rest of the stats from being read
+                gauges[name] = repr(e)
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+# Turns a snapshot (or the stats a server replies to STATS with) into readable lines
+# Durations are shown in milliseconds
+def format_stats(stats):
+    lines = []
+    for key, value in stats.items():
+        if key not in ('counters', 'histograms', 'gauges'):
+            lines.append(f'{key}: {value}')
+    for name, value in sorted(stats.get('gauges', {}).items()):
+        lines.append(f'{name}: {value}')
+    for name, value in sorted(stats.get('counters', {}).items()):
+        lines.append(f'{name}: {value}')
+    for name, summary in sorted(stats.get('histograms', {}).items()):
+        values = ', '.join(f'{key} {value * 1000:.3f}' for key, value in summary.items() if key != 'count')
+        lines.append(f'{name}: count {summary["count"]}' + (f', {values} ms' if values else ''))
+    return lines
+
+
+metrics = Metrics()
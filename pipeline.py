@@ -0,0 +1,66 @@
+#!/usr/bin/env python3.10
+# Puts multicasts in order and sends them on threads of their own, apart from the threads that handle commands
+import logging
+import queue
+import threading
+from time import monotonic
+
+from metrics import metrics
+
+log = logging.getLogger('pipeline')
+
+
+# Messages are submitted to a bounded queue, and taken off it in order by a single sequencer thread
+# The sequencer calls sequence with each message, which gives it its clock value(s) and returns the arguments for send,
+# or None if there is nothing to send. Sender threads then call send
+# Messages submitted with the same key always go to the same sender, so they are sent in the order they were sequenced
+# Submitting blocks while the queue is full, which slows down whoever is producing messages instead of letting the
+# queue grow without limit. How often that happens and for how long is recorded in the metrics
+class MulticastPipeline:
+    def __init__(self, sequence, send, queue_size=1024, senders=1):
+        self.sequence = sequence
+        self.send = send
+        self.queue = queue.Queue(queue_size)
+        self.send_queues = [queue.Queue() for _ in range(senders)]
+
+    def start(self):
+        threading.Thread(target=self.run_sequencer, name='sequencer').start()
+        for i, send_queue in enumerate(self.send_queues):
+            threading.Thread(target=self.run_sender, args=(send_queue,), name=f'sender-{i}').start()
+
+    def submit(self, key, *message):
+        item = (monotonic(), key, message)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            metrics.count('sequencer.queue_full')
+            start = monotonic()
+            self.queue.put(item)
+            metrics.observe('sequencer.blocked_seconds', monotonic() - start)
+
+    # Stops the threads once everything submitted before this has been sent
+    def stop(self):
+        self.queue.put(None)
+
+    def run_sequencer(self):
+        while (item := self.queue.get()) is not None:
+            submitted, key, message = item
+            metrics.observe('sequencer.queue_seconds', monotonic() - submitted)
+            try:
+                to_send = self.sequence(*message)
+            except Exception:
+                log.exception('Error sequencing multicast')
+                continue
+            if to_send is not None:
+                self.send_queues[hash(key) % len(self.send_queues)].put(to_send)
+
+        for send_queue in self.send_queues:
+            send_queue.put(None)
+        log.info('Sequencer closing')
+
+    def run_sender(self, send_queue):
+        while (item := send_queue.get()) is not None:
+            try:
+                self.send(*item)
+            except OSError as e:
+                log.warning('Error sending multicast: %r', e)
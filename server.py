@@ -1,11 +1,30 @@
 #!/usr/bin/env python3.10
 
+import argparse
+import asyncio
+import logging
+import os
 import socket
 import sys
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import quote
 from utility import BUFFER_SIZE, encode_message, decode_message, format_join_quit
 import utility
-from time import sleep
+from chatlog import ChatLog
+from history import MessageHistory, HoldBackQueue
+from failure_detector import PhiAccrualDetector
+from flow_control import RateLimiter, SendWindows
+from membership import Membership
+from metrics import metrics
+from pipeline import MulticastPipeline
+from workers import WorkerPool
+from time import sleep, monotonic
+
+# Messages about single commands and multicasts are logged at DEBUG, so they cost next to nothing at the default level
+log = logging.getLogger('server')
 
 
 # Create TCP socket for listening to unicast messages
@@ -13,9 +32,32 @@ from time import sleep
 server_socket = utility.setup_tcp_listener_socket()
 server_address = server_socket.getsockname()
 
-# Lists for connected clients and servers
-clients = []
-servers = [server_address]  # Server list starts with this server in it
+# Registries of the connected clients and servers
+# Each client's metadata holds the server that owns it ('owner') and the room it is in ('room')
+# The leader spreads the clients over the servers, see assign_client
+clients = Membership()
+servers = Membership([server_address])  # Server list starts with this server in it
+
+# Datagrams sent straight to this server arrive on datagram_socket, which is on the same address as server_socket
+# With --asyncio, the socket belongs to datagram_transport on the event loop
+datagram_socket = utility.setup_udp_listener_socket(server_address)
+datagram_transport = None
+
+# Every client holds a lease with the server that owns it, which anything it sends renews
+# An idle client renews it with an ALIVE datagram
+# Every LEASE_CHECK_INTERVAL seconds, the clients whose leases are more than LEASE_TIMEOUT seconds old are removed
+# together, see expire_leases
+LEASE_TIMEOUT = 5
+LEASE_CHECK_INTERVAL = 1
+
+# Every server pings its neighbor in the ring with a datagram every HEARTBEAT_INTERVAL seconds
+# The PONGs it gets back are the heartbeats the failure detector keeps track of. Once the neighbor's phi
+# (how sure we are that it is gone) goes over PHI_THRESHOLD, it is removed
+# A lower threshold notices a failed server sooner, but takes a server that is only slow for gone, which causes
+# needless elections, more often. The phi of the neighbor is in the stats, to tune it by
+HEARTBEAT_INTERVAL = 0.2
+PHI_THRESHOLD = 8.0
+failure_detector = PhiAccrualDetector(HEARTBEAT_INTERVAL)
 
 # Variables for leadership and voting
 leader_address = None
@@ -23,29 +65,228 @@ is_leader = False
 is_voting = False
 neighbor = None
 
+# How the servers elect a leader, which every server has to be started with the same way
+# 'ring' passes votes around the ring (LeLann-Chang-Roberts), one connection after the other, so it takes two trips
+# around the ring. 'bully' sends the vote straight to every server with a higher address, and the highest one that
+# is still there tells every server that it is the leader, see bully_vote
+# A bully vote that was delivered to a higher server waits ELECTION_TIMEOUT seconds for it to say it is the leader,
+# and votes again if it doesn't, in case that server went down in the meantime
+ELECTION_MODE = 'ring'
+ELECTION_TIMEOUT = 1.0
+
 # Flag to enable stopping the client
 is_active = True
 
-# Counts for server and client multicasts
-server_clock = [0]
-client_clock = [0]
-
-# Dicts for the server and client mulitcast messages
-server_multi_msgs = {}
-client_multi_msgs = {}
-# How many messages we want to store in the dictionaries
-keep_msgs = 5
+# Set from the command line to skip the startup broadcast
+# join_address is a server to join straight away, start_as_leader makes this server the leader straight away
+join_address = None
+start_as_leader = False
+
+# Only set when running with --asyncio, see async_main
+event_loop = None
+shutdown_event = None
+# Runs every handler that changes the server's state, one at a time, off the event loop
+command_executor = None
+
+# Commands received over tcp are handled one at a time, even though each connection has its own thread
+tcp_command_lock = threading.Lock()
+
+# The connections only read and decode the messages. They are handled by COMMAND_WORKERS worker threads, and the
+# messages of each sender always by the same one, so they are handled in the order they were sent
+# Commands that change the state still take turns with tcp_command_lock, or run on the command thread with --asyncio
+# CONCURRENT_COMMANDS only read it, so they are handled straight away, and a chat doesn't wait for a slow JOIN
+# Each worker queues at most COMMAND_QUEUE_SIZE messages, after that the connections filling it wait
+COMMAND_WORKERS = 4
+COMMAND_QUEUE_SIZE = 256
+CONCURRENT_COMMANDS = {'CHAT', 'ROUTE', 'NACK', 'HISTORY', 'SYNC', 'STATS'}
+command_workers = WorkerPool(COMMAND_WORKERS, COMMAND_QUEUE_SIZE, name='dispatch')
+
+# Chats that arrive within CHAT_BATCH_WINDOW seconds of the first one are multicast together as one BATCH
+# A batch is sent early once it holds CHAT_BATCH_SIZE chats or CHAT_BATCH_BYTES bytes of chat
+# Setting the window to 0 turns batching off, and every chat is multicast on its own
+CHAT_BATCH_WINDOW = 0
+CHAT_BATCH_SIZE = 50
+CHAT_BATCH_BYTES = utility.MAX_DATAGRAM_SIZE // 2
+# The leader gives every client a small id when it joins, which is never given to another client
+# With SENDER_IDS, chats carry the id of the client that sent them instead of its address, which the clients are told
+# about with a JOIN multicast to every room, and with the list of ids in ROOM. See chat_sender
+# Every server should be started with the same setting, see also COMPRESSION in utility.py
+SENDER_IDS = False
+last_sender_id = [0]
+# Each room has its own batch, as {'chats': list of chats, 'bytes': bytes of chat in it, 'id': batch id}
+# The id increases with every batch sent, so a timer never sends a newer batch than the one it was set for
+chat_batches = {}
+chat_batch_lock = threading.Lock()
+
+# Multicasts are sent from one socket, and the acks for them are collected by ack_listener
+# A send is resolved as soon as every expected recipient has acked it, or once ACK_TIMEOUT seconds have passed
+ACK_TIMEOUT = 0.2
+multicast_socket = utility.setup_multicast_sender_socket()
+# Sends waiting for acks, keyed by (group name, last clock value of the message)
+pending_acks = {}
+pending_acks_lock = threading.Lock()
+
+# Replication of the multicasts over the servers, so that a server taking over a room or the leadership loses none
+# A server only acks a multicast once it has stored it in its history, and a multicast is committed once
+# REPLICATION_QUORUM of the other servers have acked it (or all of them, if there are fewer)
+# Servers that haven't acked it by ACK_TIMEOUT are sent it over tcp, see replicate
+# How long committing takes is recorded as replication.commit_seconds
+# A server that takes over multicasting to a group first asks the other servers for every message of it they have,
+# and carries on from the highest clock value any of them has, which is at least that of the last committed message
+# Multicasts to the group wait until every server has answered, or RECOVERY_TIMEOUT seconds have passed,
+# see recover_group. Chats that couldn't be routed to a sequencer that is gone are kept until the room has a new one
+# A message that reached no other server before its sequencer failed can still be lost, and only that
+REPLICATION_QUORUM = 1
+RECOVERY_TIMEOUT = 1.0
+UNROUTED_LIMIT = 1024
+recovery_lock = threading.Lock()
+
+# Flow control for slow clients
+# Multicasts a client didn't ack are sent to it again over tcp, off the command thread, see retransmit
+# A client can only have SEND_WINDOW of those sends going at once, anything more is left for it to NACK
+# A client that misses the acks of LAGGARD_THRESHOLD multicasts in a row is a laggard. It is no longer waited for
+# or sent every multicast it misses again, and LAGGARD_POLICY decides what happens to it:
+#   'drop' leaves it to NACK what it missed once it acks again
+#   'replay' sends it everything from the first multicast it missed, REPLAY_CHUNK clock values at a time every
+#   REPLAY_INTERVAL seconds, until it has caught up
+#   'disconnect' removes it from the chatroom, like a client whose lease ran out
+# Each client can NACK NACK_RATE times a second, and up to NACK_BURST times at once
+SEND_WINDOW = 4
+LAGGARD_THRESHOLD = 64
+LAGGARD_POLICY = 'replay'
+REPLAY_CHUNK = 256
+REPLAY_INTERVAL = 0.05
+NACK_RATE = 20
+NACK_BURST = 40
+send_windows = SendWindows(SEND_WINDOW)
+nack_limiter = RateLimiter(NACK_RATE, NACK_BURST)
+# Replaced rather than changed, so the sequencer thread can use it without taking the lock
+lagging_clients = frozenset()
+lagging_lock = threading.Lock()
+
+# Multicasts are given their clock values by a single sequencer thread, and sent by MULTICAST_SENDERS sender threads
+# Whoever multicasts only has to wait if MULTICAST_QUEUE_SIZE messages are already waiting to be sequenced
+# Each group always uses the same sender, so its messages go out in clock order
+MULTICAST_QUEUE_SIZE = 1024
+MULTICAST_SENDERS = 1
+multicast_pipeline = MulticastPipeline(lambda *message: sequence_multicast(*message),
+                                       lambda data, address: multicast_socket.sendto(data, address),
+                                       queue_size=MULTICAST_QUEUE_SIZE, senders=MULTICAST_SENDERS)
+
+# Every multicast group has its own clock, history and hold back queue, see add_multicast_group
+# The servers share the group named 'server', and every chat room is a group named after the room
+# Each history keeps the last HISTORY_DEPTH clock values, and is used to resend messages that were missed
+# Multicasts are delivered in clock order through the hold back queues. A gap is NACKed, and asked for again
+# after NACK_RETRY seconds. They start out holding everything back, until the clocks are known from the leader's state
+# or from becoming leader
+HISTORY_DEPTH = 4096
+NACK_RETRY = 0.5
+# Given a LOG_DIR, every server also writes the messages of every room to a ChatLog in it, see chatlog.py
+# The sequencer of a room logs what it multicasts, the other servers what they deliver, so each one has the whole room
+# NACKs for messages that are no longer in the history are answered from the log, and so are clients asking for
+# the history of their room with HISTORY, which gets them at most HISTORY_LIMIT messages at a time
+# With LOG_SYNC, every message is flushed to the disk rather than just to the operating system
+# Every server needs a LOG_DIR of its own
+LOG_DIR = None
+LOG_SYNC = False
+HISTORY_LIMIT = 1000
+multicast_groups = {}
+# Transports of the multicast listeners, only used with --asyncio
+multicast_transports = []
+
+# Set to the time an election started while it is running, to time how long it takes
+election_started = [None]
+
+# The clock of the server group is the version of the state the servers share, as every change to it is multicast
+# to the group by the leader. A server joining again tells the leader the last version it saw, and is resent just the
+# multicasts after it. Anything else is sent the whole state, encoded and split into parts of STATE_PART_SIZE bytes
+# on a thread of its own, so the leader carries on handling commands while it is sent, see transmit_state
+# Servers being sent the state aren't given clients or rooms until it has been sent
+STATE_PART_SIZE = 64 * 1024
+syncing_servers = set()
+# Parts of the state received so far, and the version they are from
+state_parts = {'version': None, 'parts': []}
+
+# Queue depths and list sizes, read whenever the stats are requested
+metrics.gauge('clients', lambda: len(clients))
+metrics.gauge('servers', lambda: len(servers))
+metrics.gauge('rooms', lambda: len(multicast_groups) - 1)
+metrics.gauge('owned_clients', lambda: sum(owner == server_address for owner in clients.values('owner')))
+metrics.gauge('sequenced_rooms', lambda: sum(group['sequencer'] == server_address
+                                             for group in list(multicast_groups.values())))
+metrics.gauge('pending_acks', lambda: len(pending_acks))
+metrics.gauge('uncommitted', lambda: sum(pending['committed'] is None for pending in list(pending_acks.values())))
+metrics.gauge('lagging_clients', lambda: len(lagging_clients))
+metrics.gauge('retransmissions', lambda: len(send_windows))
+metrics.gauge('multicast_queue', lambda: multicast_pipeline.queue.qsize())
+metrics.gauge('dispatch_queue', command_workers.depth)
+metrics.gauge('held_back', lambda: sum(len(group['hold_back'].held) for group in list(multicast_groups.values())))
+metrics.gauge('chat_batch', lambda: sum(len(batch['chats']) for batch in list(chat_batches.values())))
+metrics.gauge('tcp_connections', lambda: len(utility.tcp_connections))
+metrics.gauge('threads', threading.active_count)
+metrics.gauge('neighbor_phi', lambda: neighbor and round(failure_detector.phi(neighbor), 3))
 
 
 def main():
     utility.cls()
-    startup_broadcast()
+    multicast_pipeline.start()
+    command_workers.start()
+    add_multicast_group('server', utility.MG_SERVER)
+    add_multicast_group(utility.DEFAULT_ROOM, utility.MG_CLIENT, clients=set())
+    startup()
 
     threading.Thread(target=broadcast_listener).start()
     threading.Thread(target=tcp_listener).start()
     threading.Thread(target=heartbeat).start()
-    threading.Thread(target=multicast_listener, args=(utility.MG_SERVER,)).start()
-    threading.Thread(target=multicast_listener, args=(utility.MG_CLIENT,)).start()
+    threading.Thread(target=ack_listener).start()
+    threading.Thread(target=datagram_listener).start()
+    threading.Thread(target=lease_reaper).start()
+
+
+# Stops the server
+# The threads notice this the next time they wake up, the asyncio runtime is woken up straight away
+def shutdown():
+    global is_active
+    is_active = False
+    multicast_pipeline.stop()
+    command_workers.stop()
+    if event_loop:
+        event_loop.call_soon_threadsafe(shutdown_event.set)
+
+
+# Runs a state changing function after delay seconds without blocking the caller
+# With --asyncio it goes on the command thread, otherwise it gets a thread of its own
+# and takes its turn with the tcp commands
+def run_in_background(function, *args, delay=0):
+    if event_loop:
+        event_loop.call_soon_threadsafe(event_loop.call_later, delay, run_command, function, *args)
+    else:
+        threading.Timer(delay, run_with_command_lock, args=(function, *args)).start()
+
+
+def run_with_command_lock(function, *args):
+    with tcp_command_lock:
+        function(*args)
+
+
+# Finds the other servers, or becomes the leader if there are none
+def startup():
+    if join_address:
+        join_server(join_address)
+    elif start_as_leader:
+        log.info('Starting as leader')
+        set_leader(server_address)
+    else:
+        startup_broadcast()
+
+
+# Asks the leader at address to add this server. The leader replies with its state
+def join_server(address):
+    log.info('Joining server at %s', address)
+    version = multicast_groups['server']['hold_back'].clock
+    join_contents = {'node_type': 'server', 'inform_others': True, 'address': server_address, 'version': version}
+    tcp_transmit_message('JOIN', join_contents, address)
+    set_leader(address)
 
 
 # Broadcasts looking for another active server
@@ -58,35 +299,32 @@ def startup_broadcast():
     # After this, the server assumes it is the only one and considers itself leader
     for i in range(0, utility.SERVER_BROADCAST_ATTEMPTS):
         broadcast_socket.sendto(utility.BROADCAST_CODE.encode(), ('<broadcast>', utility.BROADCAST_PORT))
-        print("Looking for other servers")
+        log.info('Looking for other servers')
 
         # Wait for a response packet. If no packet has been received in 1 second, broadcast again
         try:
             data, address = broadcast_socket.recvfrom(1024)
             if data.startswith(f'{utility.RESPONSE_CODE}_{server_address[0]}'.encode()):
-                print("Found server at", address[0])
+                log.info('Found server at %s', address[0])
                 response_port = int(data.decode().split('_')[2])
-                join_contents = {'node_type': 'server', 'inform_others': True, 'address': server_address}
-                tcp_transmit_message('JOIN', join_contents, (address[0], response_port))
+                join_server((address[0], response_port))
                 got_response = True
-                set_leader((address[0], response_port))
                 break
         except TimeoutError:
             pass
 
     broadcast_socket.close()
     if not got_response:
-        print('No other servers found')
+        log.info('No other servers found')
         set_leader(server_address)
 
 
 # Function to listen for broadcasts from clients/servers and respond when a broadcast is heard
 # Only the leader responds to broadcasts
 def broadcast_listener():
-    print(f'Server up and running at {server_address}')
+    log.info('Server up and running at %s', server_address)
 
-    listener_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # create UDP socket
-    listener_socket.bind(('', utility.BROADCAST_PORT))
+    listener_socket = utility.setup_broadcast_listener_socket()
     listener_socket.settimeout(2)
 
     while is_active:
@@ -95,139 +333,486 @@ def broadcast_listener():
         except TimeoutError:
             pass
         else:
-            if is_leader and data.startswith(utility.BROADCAST_CODE.encode()):
-                print(f'Received broadcast from {address[0]}, replying with response code')
-                # Respond with the response code, the IP we're responding to, and the the port we're listening with
-                listener_socket.sendto(str.encode(f'{utility.RESPONSE_CODE}_{address[0]}_{server_address[1]}'), address)
+            response = broadcast_response(data, address)
+            if response:
+                listener_socket.sendto(response, address)
 
-    print('Broadcast listener closing')
+    log.info('Broadcast listener closing')
     listener_socket.close()
     sys.exit(0)
 
 
-# Listens for multicasted messages
-def multicast_listener(group):
-    match group:
-        case utility.MG_SERVER:
-            name = 'server'
-            clock = server_clock
-            multi_msgs = server_multi_msgs
-        case utility.MG_CLIENT:
-            name = 'client'
-            clock = client_clock
-            multi_msgs = client_multi_msgs
-        case _:
-            raise ValueError('Invalid multicast group')
+# Returns the response to a broadcast, or None if we shouldn't respond to it
+def broadcast_response(data, address):
+    if is_leader and data.startswith(utility.BROADCAST_CODE.encode()):
+        log.debug('Received broadcast from %s, replying with response code', address[0])
+        # Respond with the response code, the IP we're responding to, and the the port we're listening with
+        return str.encode(f'{utility.RESPONSE_CODE}_{address[0]}_{server_address[1]}')
+    return None
+
+
+# Creates the clock, history and hold back queue of a multicast group, and starts listening to it
+# clients is the set of clients in a room, or None for the server group
+# clock is only given when it is already known, otherwise the group holds everything back until it is
+# sequencer is the server that multicasts to a room, the leader always multicasts to the servers
+def add_multicast_group(name, address, clients=None, clock=None, sequencer=None):
+    hold_back = HoldBackQueue(lambda message: deliver_multicast(message, name),
+                              lambda first, last: request_missing(name, first, last), retry_timeout=NACK_RETRY)
+    group = {'address': address, 'clients': clients, 'clock': [0], 'history': MessageHistory(HISTORY_DEPTH),
+             'hold_back': hold_back, 'sequencer': sequencer, 'log': None, 'recovery': None,
+             'unrouted': deque(maxlen=UNROUTED_LIMIT)}
+    if LOG_DIR is not None and clients is not None:
+        group['log'] = ChatLog(os.path.join(LOG_DIR, 'room-' + quote(name, safe='')), sync=LOG_SYNC)
+    if clock is not None:
+        group['clock'][0] = clock
+        hold_back.set_clock(clock)
+    multicast_groups[name] = group
+    if event_loop:
+        asyncio.run_coroutine_threadsafe(async_multicast_listener(name), event_loop)
+    else:
+        threading.Thread(target=multicast_listener, args=(name,)).start()
+    return group
+
+
+# Listens for messages multicasted to a group
+def multicast_listener(name):
+    group = multicast_groups[name]
 
     # Create the socket
-    m_listener_socket = utility.setup_multicast_listener_socket(group)
-    m_listener_socket.settimeout(2)
+    m_listener_socket = utility.setup_multicast_listener_socket(group['address'])
+    m_listener_socket.settimeout(NACK_RETRY)
 
     while is_active:
         try:
-            data, address = m_listener_socket.recvfrom(BUFFER_SIZE)
+            data, address = m_listener_socket.recvfrom(utility.MAX_DATAGRAM_SIZE)
         except TimeoutError:
-            pass
+            group['hold_back'].check_gap()
         else:
-            message = decode_message(data)
-            # If we've picked up our own message
-            # Or the message has a lower clock than the next expected message
-            # Ignore it
-            if message['sender'] == server_address or message['clock'][0] <= clock[0]:
-                continue
-
-            print(f'Listener {name} received multicast command {message["command"]} from {message["sender"]}')
-            m_listener_socket.sendto(b'ack', address)
-
-            clock[0] += 1
-            # Causal ordering doesn't really matter here.
-            # Just has to be reliable
-            for i in range(clock[0], message['clock'][0]):
-                print(f'Requesting missing {name} message with clock {i}')
-                tcp_transmit_message('MSG', {'list': name, 'clock': [i]}, message['sender'])
-                clock[0] += 1
-
-            if clock[0] != message['clock'][0]:
-                raise ValueError(f'Clock is not correct, {clock =}')
-            multi_msgs[str(clock[0])] = {'command': message["command"], 'contents': message["contents"]}
-            if len(multi_msgs) > keep_msgs:
-                multi_msgs.pop(next(iter(multi_msgs)))
-            parse_multicast(message, group)
-
-    print(f'Multicast listener {name} closing')
+            receive_multicast(data, name, lambda ack: m_listener_socket.sendto(ack, address))
+
+    log.info('Multicast listener %s closing', name)
     m_listener_socket.close()
     sys.exit(0)
 
 
-def parse_multicast(message, group):
-    match group:
-        case utility.MG_SERVER:
-            server_command(message)
-        case utility.MG_CLIENT:
-            pass
-        case _:
-            raise ValueError(f'Invalid multicast group, {group =}')
+# Handles a multicasted message. send_ack is called with the ack once the message is accepted
+def receive_multicast(data, name, send_ack):
+    message = decode_message(data)
+    # If we've picked up our own message
+    # Or we've already delivered every clock value of the message
+    # Ignore it
+    hold_back = multicast_groups[name]['hold_back']
+    if message['sender'] == server_address or (hold_back.clock is not None and message['clock'][-1] <= hold_back.clock):
+        return
 
+    log.debug('Listener %s received multicast command %s from %s', name, message['command'], message['sender'])
+    metrics.count(f'multicast.received.{message["command"]}')
+    # The ack tells the sequencer we have a copy of the message, see REPLICATION_QUORUM, so it is only sent once we do
+    if hold_back_multicast(data, message, name):
+        send_ack(encode_message('ACK', server_address, name, message['clock']))
+
+
+# Stores the message in the history and passes it to the hold back queue, which delivers it in clock order
+# Returns False if it is for a group we don't know about
+# Causal ordering doesn't really matter here.
+# Just has to be reliable
+def hold_back_multicast(data, message, name):
+    group = multicast_groups.get(name)
+    if group is None:  # A room we haven't heard about yet. The messages will be NACKed once we have
+        return False
+    group['history'].add_range(message['clock'][0], message['clock'][-1], data)
+    for unpacked in utility.unpack_multicast(message):
+        group['hold_back'].receive(unpacked['clock'][0], unpacked)
+    return True
+
+
+# Called by the hold back queues once every earlier message has been delivered
+# Only messages to the servers are handled, chats in the rooms are just kept track of and logged
+# The chats of a BATCH are delivered one at a time, so they are logged as a CHAT each
+def deliver_multicast(message, name):
+    group = multicast_groups[name]
+    group['clock'][0] = message['clock'][0]
+    if name == 'server':
+        server_command(message)
+    elif group['log'] is not None:
+        data = encode_message(message['command'], message['sender'], message['contents'], message['clock'])
+        log_message(group, message['clock'][0], message['clock'][-1], data)
+
+
+# Asks the server that multicast to the group for every message in a gap with one NACK
+def request_missing(name, first, last):
+    sender = multicast_groups[name]['sequencer'] or leader_address
+    if sender in (None, server_address):  # Nobody to ask
+        return
+    log.debug('Requesting missing %s messages with clocks %s to %s', name, first, last)
+    metrics.count('nack.sent')
+    try:
+        tcp_transmit_message('NACK', {'list': name, 'clock': [first, last]}, sender)
+    except (ConnectionRefusedError, TimeoutError):
+        log.warning('Unable to request missing messages from %s', sender)
+
+
+# Transmits multicast messages without waiting for them to be sent or for the responses
+# The message is queued for the sequencer, see multicast_pipeline
+# While we are taking over the group, it waits with the others until we know which clock to carry on from
+# count is the number of clock values the message uses up. Only a BATCH uses more than one
+# name is 'server' or the name of a room. Only the servers and the clients in the room are expected to ack
+def multicast_transmit_message(command, contents, name, count=1):
+    group = multicast_groups[name]
+    if group['recovery'] is not None:
+        with recovery_lock:
+            if group['recovery'] is not None:
+                group['recovery']['parked'].append((command, contents, count))
+                return
+    multicast_pipeline.submit(name, command, contents, name, count)
 
-# Transmits multicast messages and checks how many responses are received
-def multicast_transmit_message(command, contents, group):
-    len_other_servers = len(servers) - 1  # We expect responses from every other than the sender
-    len_clients = len(clients)
 
-    match group:
-        case utility.MG_SERVER:
-            if not len_other_servers:  # If there are no other servers, don't bother transmitting
-                return
-            expected_responses = len_other_servers
-            send_to = 'servers'
-            multi_msgs = server_multi_msgs
-            clock = server_clock
-        case utility.MG_CLIENT:
-            if not len_clients:  # If there are no clients, don't bother transmitting
-                return
-            expected_responses = len_clients + len_other_servers
-            send_to = 'clients'
-            multi_msgs = client_multi_msgs
-            clock = client_clock
-        case _:
-            raise ValueError('Invalid multicast group')
+# Gives a multicast its clock values and stores it in the history. Only ever runs on the sequencer thread
+# Returns the message and the group to send it to, or None if there is nobody to send it to
+# The acks are tracked by ack_listener, and recipients that don't respond in time are handled in the background
+def sequence_multicast(command, contents, name, count):
+    other_servers = {s for s in servers if s != server_address}  # We expect responses from every other than the sender
+    group = multicast_groups[name]
+
+    if group['clients'] is None:
+        if not other_servers:  # If there are no other servers, don't bother transmitting
+            return
+        expected = other_servers
+    else:
+        if not group['clients']:  # If there are no clients in the room, don't bother transmitting
+            return
+        expected = other_servers | (set(group['clients']) - lagging_clients)
+
+    clock = group['clock']
+    clock[0] += count
+    # A message using up more than one clock value carries the range of values it uses
+    message_clock = [clock[0] - count + 1, clock[0]] if count > 1 else [clock[0]]
+    log.debug('Sending multicast command %s to %s with clock %s', command, name, message_clock)
+    metrics.count(f'multicast.sent.{command}')
+
+    # The send is registered before it goes out, so that no ack can arrive before we are waiting for it
+    # Without other servers there is nobody to replicate to, and the message counts as committed straight away
+    sent = monotonic()
+    quorum = min(REPLICATION_QUORUM, len(other_servers))
+    pending = {'group': name, 'clock': message_clock, 'expected': expected, 'acked': set(),
+               'sent': sent, 'deadline': sent + ACK_TIMEOUT, 'replicas': other_servers, 'quorum': quorum,
+               'committed': None if quorum else sent}
+    with pending_acks_lock:
+        pending_acks[(name, message_clock[-1])] = pending
+
+    message_bytes = encode_message(command, server_address, contents, message_clock)
+    group['history'].add_range(message_clock[0], message_clock[-1], message_bytes)
+    if group['log'] is not None:
+        log_message(group, message_clock[0], message_clock[-1], message_bytes)
+    return message_bytes, group['address']
+
+
+def log_message(group, first, last, data):
+    if group['log'].append(first, last, data):
+        metrics.count('chatlog.messages')
+        metrics.count('chatlog.bytes', len(data))
+
+
+# Messages of a group using clock values from first to last, oldest first, and at most limit of them
+# They come from the history if it still has the first one. Otherwise they come from the log,
+# with anything that hasn't been logged yet from the history
+def read_history(name, first, last, limit=None):
+    group = multicast_groups[name]
+    chat_log = group['log']
+    if chat_log is None or group['history'].get(first) is not None or first > chat_log.last_clock:
+        messages = group['history'].get_range(first, last)
+    else:
+        start = monotonic()
+        logged = chat_log.last_clock
+        messages = chat_log.read(first, last, limit)
+        if last > logged:
+            messages += group['history'].get_range(logged + 1, last)
+        metrics.count('chatlog.replayed', len(messages))
+        metrics.observe('chatlog.replay_seconds', monotonic() - start)
+    return messages if limit is None else messages[:limit]
+
+
+# Collects the acks for multicasts sent by this server
+def ack_listener():
+    multicast_socket.settimeout(ACK_TIMEOUT / 4)
+    while is_active:
+        try:
+            data, address = multicast_socket.recvfrom(BUFFER_SIZE)
+        except TimeoutError:
+            pass
+        else:
+            receive_ack(data)
+        expire_pending_acks()
+
+    log.info('Ack listener closing')
+    multicast_socket.close()
+    sys.exit(0)
 
-    clock[0] += 1
-    print(f'Sending multicast command {command} to {send_to} with clock {clock[0]}')
 
-    # Create the socket
-    m_sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    m_sender_socket.settimeout(0.2)
-    m_sender_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+# Records who an ack came from, and resolves the send once everyone has acked it
+def receive_ack(data):
+    match decode_message(data):
+        case {'command': 'ACK', 'sender': sender, 'contents': name, 'clock': clock}:
+            clients.touch(sender) or servers.touch(sender)
+            if sender in lagging_clients:
+                clear_laggard(sender)
+            elif clients.get(sender, 'missed'):
+                clients.set(sender, missed=0)
+            with pending_acks_lock:
+                pending = pending_acks.get((name, clock[-1]))
+                if pending is None:  # Already resolved
+                    return
+                pending['acked'].add(sender)
+                is_committed = pending['committed'] is None and sender in pending['replicas'] and \
+                    len(pending['acked'] & pending['replicas']) >= pending['quorum']
+                if is_committed:
+                    pending['committed'] = monotonic()
+                is_resolved = pending['expected'] <= pending['acked']
+                if is_resolved:
+                    del pending_acks[(name, clock[-1])]
+            if is_committed:
+                metrics.count('replication.commits')
+                metrics.observe('replication.commit_seconds', pending['committed'] - pending['sent'])
+            if is_resolved:
+                resolve_pending_ack(pending)
+
+
+# Resolves every send whose time for acks has run out
+def expire_pending_acks():
+    now = monotonic()
+    with pending_acks_lock:
+        expired = [key for key, pending in pending_acks.items() if pending['deadline'] <= now]
+        expired = [pending_acks.pop(key) for key in expired]
+    for pending in expired:
+        resolve_pending_ack(pending)
+
+
+# Clients that didn't ack are sent the message again over tcp, which also checks that they are still there
+# This happens in the background, so the listener that resolved the send can carry on
+# Without it, a client that missed the last message before a quiet spell wouldn't notice the gap to NACK it
+# A client that keeps missing them becomes a laggard, see LAGGARD_POLICY
+def resolve_pending_ack(pending):
+    missing = pending['expected'] - pending['acked']
+    acked = len(pending['expected']) - len(missing)
+    log.debug('Received %s of %s expected responses', acked, len(pending['expected']))
+    metrics.count('multicast.acks_expected', len(pending['expected']))
+    metrics.count('multicast.acks_received', acked)
+    if missing:
+        metrics.count('multicast.ack_timeouts')
+    else:
+        metrics.observe('multicast.ack_seconds', monotonic() - pending['sent'])
+    if pending['committed'] is None:
+        replicate(pending)
+    missing_clients = [address for address in missing if address in clients and address not in lagging_clients]
+    if not missing_clients:
+        return
+    metrics.count('resend.clients', len(missing_clients))
+    first, last = pending['clock'][0], pending['clock'][-1]
+    messages = multicast_groups[pending['group']]['history'].get_range(first, last)
+    resend = {'list': pending['group'], 'clock': [first, last], 'messages': messages}
+    laggards = []
+    for client in missing_clients:
+        missed = clients.get(client, 'missed', 0) + 1
+        clients.set(client, missed=missed)
+        if missed == 1:
+            clients.set(client, lag_from=first)
+        if missed >= LAGGARD_THRESHOLD:
+            laggards.append(client)
+        else:
+            retransmit(client, resend)
+    if laggards:
+        add_laggards(laggards, pending['group'])
+
+
+# Sends a multicast that hadn't been committed by the time the acks ran out to the servers that didn't ack it,
+# on a thread of its own. Each server it is sent to counts as a replica, as it stores a RESEND like a multicast
+# Servers share the send windows with the clients, so a server that is gone but not removed yet
+# only holds up SEND_WINDOW threads. Anything more is left for it to NACK
+def replicate(pending):
+    missing = [server for server in pending['replicas'] - pending['acked']
+               if server in servers and send_windows.acquire(server)]
+    if missing:
+        threading.Thread(target=send_replicas, args=(pending, missing)).start()
+    else:
+        metrics.count('replication.uncommitted')
 
-    responses = 0
 
+def send_replicas(pending, missing):
+    first, last = pending['clock'][0], pending['clock'][-1]
+    messages = multicast_groups[pending['group']]['history'].get_range(first, last)
     try:
-        # Send message to the multicast group
-        message_bytes = encode_message(command, server_address, contents, clock)
-        m_sender_socket.sendto(message_bytes, group)
+        results = tcp_fan_out('RESEND', {'list': pending['group'], 'clock': [first, last], 'messages': messages},
+                              missing)
+    finally:
+        for server in missing:
+            send_windows.release(server)
+    metrics.count('replication.resent', len(results))
+    stored = len(pending['acked'] & pending['replicas']) + sum(error is None for error in results.values())
+    if stored >= pending['quorum']:
+        metrics.count('replication.commits')
+        metrics.observe('replication.commit_seconds', monotonic() - pending['sent'])
+    else:
+        log.warning('%s message with clocks %s is only on %s servers', pending['group'], pending['clock'], stored)
+        metrics.count('replication.uncommitted')
 
-        # Look for responses from all recipients
-        while True:
-            try:
-                data, server = m_sender_socket.recvfrom(16)
-            except TimeoutError:
-                break
-            else:
-                responses += 1
+
+# Sends multicasts a client missed again, on a thread of its own, so a slow client doesn't hold up the caller
+# Anything that doesn't fit in the client's send window is left for the client to NACK
+def retransmit(address, contents):
+    if not send_windows.acquire(address):
+        metrics.count('resend.window_full')
+        return
+    threading.Thread(target=send_retransmission, args=(address, contents)).start()
+
+
+def send_retransmission(address, contents):
+    try:
+        tcp_transmit_message('RESEND', contents, address)
+    except (ConnectionRefusedError, TimeoutError):
+        client_unreachable(address)
     finally:
-        print(f'Received {responses} of {expected_responses} expected responses')
-        m_sender_socket.close()
-        if group == utility.MG_CLIENT and responses < expected_responses:
-            ping_clients()
+        send_windows.release(address)
+
+
+# Stops waiting for the clients' acks, and deals with them according to LAGGARD_POLICY
+def add_laggards(laggards, name):
+    global lagging_clients
+    with lagging_lock:
+        lagging_clients = lagging_clients | set(laggards)
+    log.warning('%s clients are falling behind in room %s', len(laggards), name)
+    metrics.count(f'laggards.{LAGGARD_POLICY}', len(laggards))
+    if LAGGARD_POLICY == 'replay':
+        for client in laggards:
+            threading.Thread(target=replay_to, args=(client, name, clients.get(client, 'lag_from', 1))).start()
+    elif LAGGARD_POLICY == 'disconnect':
+        run_in_background(disconnect_clients, laggards)
+
+
+# A laggard is waited for again once it acks a multicast, or has been replayed everything it missed
+def clear_laggard(address):
+    global lagging_clients
+    with lagging_lock:
+        lagging_clients = lagging_clients - {address}
+    clients.set(address, missed=0)
+
+
+# Sends a laggard every multicast of the room from first on, a chunk at a time, until it has caught up
+# Stops if the client leaves the room or can't be reached
+def replay_to(address, name, first):
+    while is_active and clients.get(address, 'room') == name:
+        last = min(first + REPLAY_CHUNK - 1, multicast_groups[name]['clock'][0])
+        if first > last:
+            break
+        messages = read_history(name, first, last)
+        try:
+            tcp_transmit_message('RESEND', {'list': name, 'clock': [first, last], 'messages': messages}, address)
+        except (ConnectionRefusedError, TimeoutError):
+            client_unreachable(address)
+            break
+        metrics.count('replay.messages', len(messages))
+        first = last + 1
+        sleep(REPLAY_INTERVAL)
+    clear_laggard(address)
+
+
+# Listens for the datagrams sent straight to this server
+def datagram_listener():
+    datagram_socket.settimeout(2)
+    while is_active:
+        try:
+            data, address = datagram_socket.recvfrom(BUFFER_SIZE)
+        except TimeoutError:
+            pass
+        else:
+            receive_datagram(data, partial(send_datagram, address=address))
+
+    log.info('Datagram listener closing')
+    datagram_socket.close()
+    sys.exit(0)
+
 
-    multi_msgs[str(clock[0])] = {'command': command, 'contents': contents}
-    if len(multi_msgs) > keep_msgs:
-        multi_msgs.pop(next(iter(multi_msgs)))
+# Handles a datagram sent straight to this server. reply is called with the reply, if there is one
+# Nothing here changes the server's state, so it doesn't wait for the command lock
+def receive_datagram(data, reply):
+    match decode_message(data):
+        # Renews a client's lease
+        case {'command': 'ALIVE', 'sender': sender}:
+            clients.touch(sender)
+        # Answers a heartbeat with the time it was sent, so the neighbor can work out the round trip time
+        case {'command': 'PING', 'contents': float(sent)}:
+            reply(encode_message('PONG', server_address, sent))
+        case {'command': 'PONG', 'sender': sender, 'contents': float(sent)}:
+            failure_detector.heartbeat(sender)
+            metrics.observe('heartbeat.rtt_seconds', monotonic() - sent)
 
 
-# Function to listen for tcp (unicast) messages
-# passes valid commands to server_command
+# With --asyncio, this is only called from the event loop
+def send_datagram(data, address):
+    try:
+        if datagram_transport:
+            datagram_transport.sendto(data, address)
+        else:
+            datagram_socket.sendto(data, address)
+    except OSError as e:
+        log.warning('Unable to send a datagram to %s: %r', address, e)
+
+
+def lease_reaper():
+    while is_active:
+        sleep(LEASE_CHECK_INTERVAL)
+        run_with_command_lock(expire_leases)
+
+    log.info('Lease reaper closing')
+    sys.exit(0)
+
+
+# Removes the clients we own whose leases have run out, all with one QUIT
+# Only the leader changes the lists, so anywhere else the QUIT goes to the leader. If it can't be reached,
+# the clients are still expired the next time we check
+def expire_leases():
+    now = monotonic()
+    expired = [client for client, owner in clients.items('owner')
+               if owner == server_address and now - clients.get(client, 'last_seen', now) > LEASE_TIMEOUT]
+    if not expired:
+        return
+
+    log.warning('The leases of %s clients have expired', len(expired))
+    metrics.count('leases.expired', len(expired))
+    disconnect_clients(expired)
+
+
+# Has the leader remove the clients from the chatroom
+def disconnect_clients(addresses):
+    if is_leader or leader_address is None:
+        remove_clients(addresses, True)
+        return
+    try:
+        tcp_transmit_message('QUIT', {'node_type': 'client', 'inform_others': True, 'addresses': addresses},
+                             leader_address)
+    except (ConnectionRefusedError, TimeoutError):
+        log.warning('Unable to send to the leader at %s', leader_address)
+
+
+# Removes clients that are no longer there
+# If inform_others is set, their rooms are told, and so are the other servers, with one QUIT for all of them
+def remove_clients(addresses, inform_others):
+    removed = []
+    for address in map(tuple, addresses):
+        room = clients.get(address, 'room', utility.DEFAULT_ROOM)
+        remove_client_from_room(address)
+        if clients.remove(address):
+            removed.append(address)
+            if inform_others:
+                message_to_room(room, 'SERV', f'{address[0]} is unreachable')
+    if not removed:
+        return
+    log.info('Removed %s clients', len(removed))
+    if inform_others:
+        message_to_servers('QUIT', {'node_type': 'client', 'inform_others': False, 'addresses': removed})
+
+
+# Function to listen for tcp (unicast) connections
+# Connections are kept open by the sender, so each one gets its own thread to read messages from
 def tcp_listener():
     server_socket.settimeout(2)
     while is_active:
@@ -236,49 +821,125 @@ def tcp_listener():
         except TimeoutError:
             pass
         else:
-            message = decode_message(client.recv(BUFFER_SIZE))
-            if message['command'] != 'PING':  # We don't print pings since that would be a lot
-                print(f'Command {message["command"]} received from {message["sender"]}')
-            server_command(message)
+            threading.Thread(target=tcp_connection_handler, args=(client,)).start()
 
-    print('Unicast listener closing')
+    log.info('Unicast listener closing')
     server_socket.close()
+    utility.close_tcp_connections()
+
 
+# Reads every message sent over a connection and passes it on
+def tcp_connection_handler(connection):
+    for data in utility.receive_tcp_messages(connection, lambda: is_active):
+        receive_tcp_message(data)
 
-# Function to ping the neighbor, and respond if unable to do so
+
+# Hands the message to the worker of its sender, see command_workers
+# Returns False if block isn't set and the worker's queue is full
+def receive_tcp_message(data, block=True):
+    message = decode_message(data)
+    return command_workers.submit(message['sender'], dispatch_command, message, block=block)
+
+
+# Runs on a worker. Commands that change the state wait for their turn
+def dispatch_command(message):
+    if message['command'] in CONCURRENT_COMMANDS:
+        handle_command(message)
+    elif event_loop:
+        command_executor.submit(handle_command, message).result()
+    else:
+        with tcp_command_lock:
+            handle_command(message)
+
+
+# Passes valid commands to server_command, and times how long each command takes to handle
+def handle_command(message):
+    start = monotonic()
+    command = message['command']
+    clients.touch(message['sender']) or servers.touch(message['sender'])
+    log.debug('Command %s received from %s', command, message['sender'])
+    server_command(message)
+    metrics.count(f'commands.{command}')
+    metrics.observe(f'command_seconds.{command}', monotonic() - start)
+
+
+# Function to ping the neighbor, and remove it once it seems to be gone
 def heartbeat():
-    missed_beats = 0
     while is_active:
-        if neighbor:
-            try:
-                tcp_transmit_message('PING', '', neighbor)
-                sleep(0.2)
-            except (ConnectionRefusedError, TimeoutError):
-                missed_beats += 1
-            else:
-                missed_beats = 0
-            if missed_beats > 4:                                                         # Once 5 beats have been missed
-                print(f'{missed_beats} failed pings to neighbor, remove {neighbor}')     # print to console
-                servers.remove(neighbor)                                                 # remove the missing server
-                missed_beats = 0                                                         # reset the count
-                tcp_msg_to_servers('QUIT', format_join_quit('server', False, neighbor))  # inform the others
-                neighbor_was_leader = neighbor == leader_address                         # check if neighbor was leader
-                find_neighbor()                                                          # find a new neighbor
-                if neighbor_was_leader:                                                  # if the neighbor was leader
-                    print('Previous neighbor was leader, starting election')             # print to console
-                    vote()                                                               # start an election
-
-    print('Heartbeat thread closing')
+        watched = neighbor
+        if watched and ping_neighbor(watched):
+            run_with_command_lock(remove_neighbor, watched)
+        sleep(HEARTBEAT_INTERVAL)
+
+    log.info('Heartbeat thread closing')
     sys.exit(0)
 
 
+# Pings the neighbor, and returns whether its phi has gone over PHI_THRESHOLD
+# Each ping carries the time it was sent, which the neighbor sends back in a PONG to measure the round trip time
+def ping_neighbor(watched):
+    send_datagram(encode_message('PING', server_address, monotonic()), watched)
+    phi = failure_detector.phi(watched)
+    if phi <= PHI_THRESHOLD:
+        return False
+    log.warning('Neighbor %s seems to be gone, phi %.1f, removing it', watched, phi)
+    metrics.count('heartbeat.suspected')
+    return True
+
+
+# Removes the neighbor after it stopped responding to heartbeats
+# Nothing is done if it stopped being our neighbor in the meantime
+def remove_neighbor(dead_neighbor):
+    if dead_neighbor != neighbor:
+        return
+    failure_detector.remove(dead_neighbor)
+    servers.remove(dead_neighbor)                                                 # remove the missing server
+    tcp_msg_to_servers('QUIT', format_join_quit('server', False, dead_neighbor))  # inform the others
+    tell_removed_server(dead_neighbor)                                            # and the neighbor itself
+    neighbor_was_leader = dead_neighbor == leader_address                         # check if neighbor was leader
+    find_neighbor()                                                               # find a new neighbor
+    if neighbor_was_leader:                                                       # if the neighbor was leader
+        log.info('Previous neighbor was leader, starting election')               # log it
+        vote()                                                                    # start an election
+    elif is_leader:                                                               # if we are the leader
+        reassign_orphans()                                                        # hand out its clients and rooms
+
+
+# A server that was only slow to answer finds out it was removed, and joins again, see QUIT
+def tell_removed_server(address):
+    try:
+        tcp_transmit_message('QUIT', format_join_quit('server', False, address), address)
+    except (ConnectionRefusedError, TimeoutError):
+        pass
+
+
 def server_command(message):
     match message:
-        # Sends the chat message to all clients
+        # Only the leader changes who is in the chatroom
+        # Requests from the nodes themselves that reach another server are passed on to the leader
+        case ({'command': 'JOIN' | 'QUIT', 'contents': {'inform_others': True}}
+              | {'command': 'ROOM', 'contents': str()}) if not is_leader and leader_address is not None:
+            forward_to_leader(message)
+        # Sends the chat message to all clients in the sender's room
         # The client is responsible for not printing messages it originally sent
         case {'command': 'CHAT', 'sender': sender, 'contents': contents}:
-            chat_message = {'chat_sender': sender, 'chat_contents': contents}
-            message_to_clients('CHAT', chat_message)
+            chat_message = {'chat_sender': chat_sender(sender), 'chat_contents': contents}
+            send_chat(clients.get(sender, 'room', utility.DEFAULT_ROOM), chat_message)
+        # A message for a room we multicast to, from the server that received it
+        # A room being handed to us can be routed to before we are told, it is then kept until we are, see reroute
+        case {'command': 'ROUTE', 'contents': {'room': room, 'command': command, 'contents': contents}}:
+            if room not in multicast_groups:
+                log.warning('Message routed to unknown room %s', room)
+            elif multicast_groups[room]['sequencer'] not in (None, server_address):
+                multicast_groups[room]['unrouted'].append((command, contents))
+            elif command == 'CHAT' and CHAT_BATCH_WINDOW:
+                add_to_chat_batch(room, contents)
+            else:
+                multicast_transmit_message(command, contents, room)
+        # A client that lost its server and reconnected, see reconnect in client.py
+        case {'command': 'JOIN', 'contents': {'node_type': 'client', 'inform_others': True, 'address': address,
+                                              'room': str(room), 'lost_server': lost_server}}:
+            rejoin_client(tuple(address), room, tuple(lost_server))
         # Add the provided node to this server's list
         # If the request came from the node to be added inform the other servers
         # If the node is a server, send it the server and client lists
@@ -291,19 +952,30 @@ def server_command(message):
             else:
                 raise ValueError(f'Tried to add invalid node type: {node_type =}')
 
+            # New clients are handed to a server, which every server is told about
+            metadata = {}
+            if node_type == 'client':
+                owner = metadata['owner'] = message['contents'].get('owner') or assign_client(address)
+                sender_id = metadata['id'] = new_sender_id(message['contents'].get('id'))
+
             if inform_others:
-                message_to_servers('JOIN', format_join_quit(node_type, False, address))
                 if node_type == 'client':
-                    message_to_clients('SERV', f'{address[0]} has joined the chat')
-                    tcp_transmit_message('CLOCK', client_clock, address)
+                    message_to_servers('JOIN', format_join_quit(node_type, False, address)
+                                       | {'owner': owner, 'id': sender_id})
+                    message_to_room(utility.DEFAULT_ROOM, 'SERV', f'{address[0]} has joined the chat')
+                    announce_sender(address, sender_id)
+                    transmit_room(utility.DEFAULT_ROOM, address)
+                    transmit_assignment(owner, address, sender_id)
                 elif node_type == 'server':
-                    transmit_state(address)
+                    message_to_servers('JOIN', format_join_quit(node_type, False, address))
+                    transmit_state(address, message['contents'].get('version'))
 
-            if address not in node_list:  # We NEVER want duplicates in our lists
-                print(f'Adding {address} to {node_type} list')
-                node_list.append(address)
+            if node_list.add(address, **metadata):  # We NEVER want duplicates in our lists
+                log.info('Adding %s to %s list', address, node_type)
                 if node_type == 'server':
                     find_neighbor()
+                else:
+                    move_client(address, utility.DEFAULT_ROOM)
         # Remove the provided node to this server's list
         # If the request came from the node to be removed inform the other servers
         # If the node is a client, then inform the other clients
@@ -318,19 +990,42 @@ def server_command(message):
 
             if inform_others:
                 if node_type == 'client':
-                    message_to_clients('SERV', f'{address[0]} has left the chat')
+                    room = clients.get(address, 'room', utility.DEFAULT_ROOM)
+                    message_to_room(room, 'SERV', f'{address[0]} has left the chat')
                 message_to_servers('QUIT', format_join_quit(node_type, False, address))
-            try:
-                print(f'Removing {address} from {node_type} list')
-                node_list.remove(address)
-                if node_type == 'server':
-                    find_neighbor()
-            except ValueError:
-                print(f'{address} was not in {node_type} list')
-        # Calls a function to import the current state from the leader
+            # The other servers took us for gone, but we are still here
+            if node_type == 'server' and address == server_address:
+                if leader_address not in (None, server_address):
+                    log.warning('Removed from the servers, joining again')
+                    join_server(leader_address)
+                return
+            log.info('Removing %s from %s list', address, node_type)
+            if node_type == 'client':
+                remove_client_from_room(address)
+            if not node_list.remove(address):
+                log.info('%s was not in %s list', address, node_type)
+            elif node_type == 'server':
+                find_neighbor()
+                if is_leader:
+                    reassign_orphans()
+        # Clients whose leases have expired, removed together
+        case {'command': 'QUIT',
+              'contents': {'node_type': 'client', 'inform_others': inform_others, 'addresses': addresses}}:
+            remove_clients(addresses, inform_others)
+        # A part of the state from the leader. Once every part is here, the state is imported
         # This is split of for readability and to keep global overwriting of the lists out of this function
-        case {'command': 'STATE', 'contents': state}:
-            receive_state(state)
+        case {'command': 'STATE', 'contents': {'version': version, 'part': part, 'parts': parts, 'data': data}}:
+            receive_state_part(version, part, parts, data)
+        # With bully elections, a vote from a lower server starts our own, and the winner tells everyone directly
+        # A lower server that says it won didn't know about us, so we take over from it
+        case {'command': 'VOTE', 'contents': {'vote_for': address, 'leader_elected': leader_elected}} \
+                if ELECTION_MODE == 'bully':
+            if leader_elected and address > server_address:
+                set_leader(address)
+            elif is_leader:
+                announce_leader()
+            else:
+                vote()
         # Receive a vote in the election
         # If I get a vote for myself then I've won the election. If not, then vote
         # If the leader has been elected then set the new leader
@@ -344,120 +1039,609 @@ def server_command(message):
                 if address != server_address:
                     set_leader(address)
                     tcp_transmit_message('VOTE', {'vote_for': address, 'leader_elected': True}, neighbor)
-        # Replies with the requested message to the requesting server
-        case {'command': 'MSG', 'contents': {'list': list_type, 'clock': msg_clock}, 'sender': address}:
-            if list_type == 'server':
-                multi_msgs = server_multi_msgs
-            elif list_type == 'client':
-                multi_msgs = client_multi_msgs
-            else:
-                ValueError(f'Message requested from invalid list, {list_type =}')
+        # Replies to a NACK with every requested message that is still in the history, all in one message
+        # Clients are limited in how often they can NACK, and get at most HISTORY_LIMIT messages per NACK
+        # The clock is the range of clock values requested
+        # The list is the name of the multicast group
+        case {'command': 'NACK', 'contents': {'list': list_type, 'clock': [first, last]}, 'sender': address}:
+            if list_type not in multicast_groups:
+                raise ValueError(f'Message requested from invalid list, {list_type =}')
+
+            metrics.count('nack.received')
+            if address in clients and not nack_limiter.allow(address):
+                metrics.count('nack.rate_limited')
+                return
 
-            message = multi_msgs[str(msg_clock[0])]
-            print(f'{message =}')
-            tcp_transmit_message(message['command'], message['contents'], address)
+            messages = read_history(list_type, first, last, HISTORY_LIMIT)
+            log.debug('Resending %s %s messages with clocks %s to %s', len(messages), list_type, first, last)
+            metrics.count('resend.messages', len(messages))
+            resend = {'list': list_type, 'clock': [first, last], 'messages': messages}
+            if address in clients:
+                retransmit(address, resend)
+            else:
+                tcp_transmit_message('RESEND', resend, address)
+        # Handles the messages we NACKed, the same way as if they had been multicast
+        # Messages a server had of a group we are taking over are kept apart, see recover_group
+        case {'command': 'RESEND', 'contents': {'list': list_type, 'messages': messages}, 'sender': address}:
+            if message['contents'].get('synced'):
+                receive_sync(list_type, messages, address)
+                return
+            for data in messages:
+                hold_back_multicast(data, decode_message(data), list_type)
+        # A server taking over a group asks for every message of it we have from a clock value on
+        case {'command': 'SYNC', 'contents': {'list': name, 'clock': int(first)}, 'sender': address}:
+            if name not in multicast_groups:
+                raise ValueError(f'Sync requested for invalid list, {name =}')
+
+            last = multicast_groups[name]['history'].last_clock
+            messages = read_history(name, first, last) if first <= last else []
+            log.info('Sending %s %s messages with clocks %s to %s to %s', len(messages), name, first, last, address)
+            tcp_transmit_message('RESEND', {'list': name, 'clock': [first, last], 'messages': messages,
+                                            'synced': True}, address)
+        # A client asks for the messages of a room from a clock value on, which can be older than the history
+        # A client that reconnected resumes with them, so they are sent like messages it NACKed
+        case {'command': 'HISTORY', 'contents': {'list': room, 'clock': int(first)}, 'sender': address}:
+            if room not in multicast_groups or room == 'server':
+                raise ValueError(f'History requested for invalid room, {room =}')
+
+            messages = read_history(room, max(first, 1), multicast_groups[room]['clock'][0], HISTORY_LIMIT)
+            if message['contents'].get('resume'):
+                tcp_transmit_message('RESEND', {'list': room, 'messages': messages}, address)
+            else:
+                tcp_transmit_message('HISTORY', {'list': room, 'messages': messages}, address)
+        # A client asks to move to another room
+        case {'command': 'ROOM', 'contents': str(room), 'sender': address}:
+            change_room(address, room)
+        # The leader moved a client to another room, and tells us which group and sequencer the room uses
+        case {'command': 'ROOM',
+              'contents': {'client': address, 'room': room, 'group': group, 'sequencer': sequencer, 'clock': clock}}:
+            move_client(address, room, group, sequencer, clock)
+        # The leader handed the clients and rooms of servers that are gone to other servers
+        case {'command': 'OWNER', 'contents': {'clients': owners, 'rooms': sequencers}}:
+            apply_owners(owners, sequencers)
+        # Replies with this server's metrics, see collect_stats
+        case {'command': 'STATS', 'sender': address}:
+            tcp_transmit_message('STATS', collect_stats(), address)
         # Either shutdown just this server (for testing leader election)
         # Or shutdown the whole chatroom
         case {'command': 'DOWN', 'contents': inform_others}:
             if inform_others:
                 tcp_msg_to_clients('DOWN')
                 tcp_msg_to_servers('DOWN')
-            print(f'Shutting down server at {server_address}')
-            global is_active
-            is_active = False
+            log.info('Shutting down server at %s', server_address)
+            shutdown()
 
 
 def message_to_servers(command, contents=''):
-    multicast_transmit_message(command, contents, utility.MG_SERVER)
+    multicast_transmit_message(command, contents, 'server')
 
 
 # Sends message to all servers
 def tcp_msg_to_servers(command, contents=''):
-    for server in [s for s in servers if s != server_address]:
-        try:
-            tcp_transmit_message(command, contents, server)
-        except (ConnectionRefusedError, TimeoutError):
-            print(f'Unable to send to {server}')
+    others = [server for server in servers if server != server_address]
+    for server, error in tcp_fan_out(command, contents, others).items():
+        if error is not None:
+            log.warning('Unable to send to %s', server)
+
+
+# Brings a joining server up to date
+# If it has seen the state up to a version that is still in the server group's history, it is resent the multicasts
+# since then, which it handles like any it NACKed. Otherwise it is sent the current server and client lists
+# along with the clock, history and clients of every multicast group
+# Only copying the state holds up other commands, encoding and sending it is done by send_state
+def transmit_state(address, version=None):
+    server_group = multicast_groups['server']
+    current = server_group['clock'][0]
+    if version is not None and version <= current and (
+            version == current or server_group['history'].get(version + 1) is not None):
+        messages = server_group['history'].get_range(version + 1, current)
+        log.info('Sending %s changes since version %s to %s', len(messages), version, address)
+        metrics.count('state.deltas')
+        metrics.count('state.delta_messages', len(messages))
+        tcp_transmit_message('RESEND', {'list': 'server', 'clock': [version + 1, current], 'messages': messages},
+                             address)
+        return
 
+    groups = {name: {'address': group['address'], 'clock': [group['clock'][0]],
+                     'clients': None if group['clients'] is None else list(group['clients']),
+                     'history': group['history'].entries(), 'sequencer': group['sequencer']}
+              for name, group in list(multicast_groups.items())}
+    state = {'servers': list(servers), 'clients': list(clients), 'groups': groups,
+             'owners': dict(clients.items('owner')), 'ids': dict(clients.items('id')),
+             'last_sender_id': last_sender_id[0]}
+    syncing_servers.add(address)
+    threading.Thread(target=send_state, args=(state, current, address)).start()
+
+
+def send_state(state, version, address):
+    start = monotonic()
+    data = encode_message('STATE', server_address, state)
+    parts = max(-(-len(data) // STATE_PART_SIZE), 1)
+    log.info('Sending version %s of the state to %s in %s parts', version, address, parts)
+    try:
+        for part in range(parts):
+            contents = {'version': version, 'part': part, 'parts': parts,
+                        'data': data[part * STATE_PART_SIZE:(part + 1) * STATE_PART_SIZE]}
+            tcp_transmit_message('STATE', contents, address)
+    except (ConnectionRefusedError, TimeoutError):
+        log.warning('Unable to send the state to %s', address)
+    else:
+        metrics.count('state.snapshots')
+        metrics.count('state.snapshot_bytes', len(data))
+        metrics.observe('state.snapshot_seconds', monotonic() - start)
+    finally:
+        syncing_servers.discard(address)
 
-# Transmits the current server and client lists from the leader to the new server
-# Will be expanded later for clocks
-def transmit_state(address):
-    state = {'servers': servers, 'clients': clients,
-             'server_clock': server_clock, 'client_clock': client_clock,
-             'server_multi_msgs': server_multi_msgs, 'client_multi_msgs': client_multi_msgs}
-    tcp_transmit_message('STATE', state, address)
+
+# Collects the parts of the state, and imports it once they are all here
+# A part that doesn't follow on from the ones before it means the leader started sending the state again
+def receive_state_part(version, part, parts, data):
+    if part == 0:
+        state_parts['version'] = version
+        state_parts['parts'] = []
+    elif version != state_parts['version'] or part != len(state_parts['parts']):
+        log.warning('Ignoring part %s of version %s of the state', part, version)
+        return
+    state_parts['parts'].append(data)
+    if len(state_parts['parts']) == parts:
+        state = decode_message(b''.join(state_parts['parts']))['contents']
+        state_parts['parts'] = []
+        receive_state(state)
 
 
 # Receives the current server and client lists from the leader
-# Will be expanded later for clocks
 def receive_state(state):
-    global servers, clients, server_clock, client_clock, server_multi_msgs, client_multi_msgs
+    servers.replace([server_address, *state["servers"]])  # Replace the server list, keeping this server in it
+    find_neighbor()
+
+    clients.replace(state["clients"])
+    for name, group_state in state["groups"].items():
+        group = multicast_groups.get(name)
+        if group is None:
+            group = add_multicast_group(name, tuple(group_state["address"]), clients=set())
+        if group['clients'] is not None:
+            group['clients'].clear()
+            group['clients'].update(tuple(client) for client in group_state["clients"])
+            for client in group['clients']:
+                clients.set(client, room=name)
+        group['clock'][0] = group_state["clock"][0]
+        group['hold_back'].set_clock(group['clock'][0])
+        group['history'].load(group_state["history"])
+        group['sequencer'] = group_state["sequencer"] and tuple(group_state["sequencer"])
+
+    for client, owner in state["owners"].items():
+        clients.set(client, owner=owner)
+    for client, sender_id in state["ids"].items():
+        clients.set(client, id=sender_id)
+    new_sender_id(state["last_sender_id"])
+
+
+# Everything in the metrics, plus a few values worked out from them
+def collect_stats():
+    stats = metrics.snapshot()
+    expected = stats['counters'].get('multicast.acks_expected', 0)
+    received = stats['counters'].get('multicast.acks_received', 0)
+    stats['ack_ratio'] = received / expected if expected else None
+    stats['address'] = server_address
+    stats['leader'] = leader_address
+    stats['suspicion'] = {f'{peer[0]}:{peer[1]}': round(phi, 3) for peer, phi in failure_detector.suspicion().items()}
+    return stats
+
+
+# Sends message to the clients in every room
+def message_to_clients(command, contents=''):
+    for name in [name for name, group in multicast_groups.items() if group['clients']]:
+        message_to_room(name, command, contents)
+
 
-    servers = [server_address]        # Clear the server list (except for this server)
-    servers.extend(state["servers"])  # Add the received list to the servers
-    servers = list(set(servers))      # Remove any duplicates
-    find_neighbor()                   # Find neighbor (also takes care of sorting)
+# Multicasts to the room if we are its sequencer, otherwise the sequencer is asked to
+def message_to_room(room, command, contents=''):
+    sequencer = multicast_groups[room]['sequencer']
+    if sequencer in (None, server_address):
+        multicast_transmit_message(command, contents, room)
+    else:
+        route_to_sequencer(sequencer, room, command, contents)
 
-    clients = []                      # Clear the client list
-    clients.extend(state["clients"])  # Add the received list to the clients
-    clients = list(set(clients))      # Remove any duplicates
 
-    server_clock[0] = state["server_clock"][0]
-    client_clock[0] = state["client_clock"][0]
+# What a chat says about who sent it, the sender's id with SENDER_IDS, or its address
+# A client that joined so recently that we weren't told its id yet is sent by its address
+def chat_sender(address):
+    sender_id = clients.get(address, 'id') if SENDER_IDS else None
+    return address if sender_id is None else sender_id
 
-    server_multi_msgs = state["server_multi_msgs"]
-    client_multi_msgs = state["client_multi_msgs"]
 
+# Returns sender_id if the leader already picked it, otherwise the next unused id
+# Every server keeps track of the last id used, so a new leader carries on from there
+def new_sender_id(sender_id=None):
+    if sender_id is None:
+        sender_id = last_sender_id[0] + 1
+    last_sender_id[0] = max(last_sender_id[0], sender_id)
+    return sender_id
 
-def message_to_clients(command, contents=''):
-    multicast_transmit_message(command, contents, utility.MG_CLIENT)
 
+# Tells the clients in every room the id of a client that joined
+def announce_sender(address, sender_id):
+    if SENDER_IDS:
+        message_to_clients('JOIN', {'address': address, 'id': sender_id})
 
-# Sends message to all clients
-def tcp_msg_to_clients(command, contents=''):
-    # This lets us iterate through the list even if we remove an element partway through
-    client_list = list(clients)
-    for client in client_list:
+
+# Chats are batched by the room's sequencer, so every chat in a batch is from the same room
+def send_chat(room, chat_message):
+    sequencer = multicast_groups[room]['sequencer']
+    if sequencer not in (None, server_address):
+        route_to_sequencer(sequencer, room, 'CHAT', chat_message)
+    elif CHAT_BATCH_WINDOW:
+        add_to_chat_batch(room, chat_message)
+    else:
+        multicast_transmit_message('CHAT', chat_message, room)
+
+
+# A message the sequencer can't be sent is kept until the room is handed to another one, see reroute
+def route_to_sequencer(sequencer, room, command, contents):
+    try:
+        tcp_transmit_message('ROUTE', {'room': room, 'command': command, 'contents': contents}, sequencer)
+    except (ConnectionRefusedError, TimeoutError):
+        log.warning('Unable to reach %s, the sequencer of room %s', sequencer, room)
+        multicast_groups[room]['unrouted'].append((command, contents))
+        metrics.count('replication.unrouted')
+
+
+# Sends the messages that couldn't be routed to the room's last sequencer to its new one
+def reroute(room):
+    unrouted = multicast_groups[room]['unrouted']
+    messages = list(unrouted)
+    unrouted.clear()
+    if messages:
+        log.info('Rerouting %s messages of room %s', len(messages), room)
+    for command, contents in messages:
+        message_to_room(room, command, contents)
+
+
+# Adds a chat to the room's batch, and sends the batch if it is full
+# The first chat in a batch sets a timer to send the batch once the window has passed
+def add_to_chat_batch(room, chat_message):
+    with chat_batch_lock:
+        batch = chat_batches.setdefault(room, {'chats': [], 'bytes': 0, 'id': 0})
+        batch['chats'].append(chat_message)
+        batch['bytes'] += len(chat_message['chat_contents'])
+        is_full = len(batch['chats']) >= CHAT_BATCH_SIZE or batch['bytes'] >= CHAT_BATCH_BYTES
+        is_first = len(batch['chats']) == 1
+        batch_id = batch['id']
+
+    if is_full:
+        send_chat_batch(room)
+    elif is_first:
+        run_in_background(send_chat_batch, room, batch_id, delay=CHAT_BATCH_WINDOW)
+
+
+# Multicasts every chat waiting in the room as one BATCH, which uses up one clock value per chat
+# If batch_id is given, the batch is only sent if it is still the same batch
+def send_chat_batch(room, batch_id=None):
+    with chat_batch_lock:
+        batch = chat_batches.get(room)
+        if not batch or not batch['chats'] or batch_id not in (None, batch['id']):
+            return
+        chats = batch['chats']
+        batch['chats'] = []
+        batch['bytes'] = 0
+        batch['id'] += 1
+
+    if len(chats) == 1:
+        message_to_room(room, 'CHAT', chats[0])
+    else:
+        multicast_transmit_message('BATCH', {'chats': chats}, room, count=len(chats))
+
+
+"""
+Chat rooms
+Every client is in exactly one room, and starts out in DEFAULT_ROOM
+Each room is a multicast group of its own, so a chat is only sent to and acked by the servers
+and the clients in its room
+The leader creates a room the first time a client asks for it, and tells the other servers which group it picked
+Rooms are never removed, so a room that empties and fills up again carries on with the same clock
+"""
+
+
+# Moves a client to the room it asked for, creating the room if it doesn't exist yet
+def change_room(address, room):
+    if address not in clients:
+        return
+    if not room or len(room) > utility.MAX_ROOM_NAME or room == 'server':
+        tcp_transmit_message('SERV', f'{room!r} is not a valid room name', address)
+        return
+    old_room = clients.get(address, 'room')
+    if room == old_room:
+        transmit_room(room, address)
+        return
+
+    move_client(address, room)
+    group = multicast_groups[room]
+    update = {'client': address, 'room': room, 'group': group['address'], 'sequencer': group['sequencer'],
+              'clock': group['clock'][0]}
+    # The client's server and the room's sequencer are told straight away, as the client's next chat goes through them
+    # The multicast that tells every server can arrive after that chat
+    for server in {clients.get(address, 'owner'), group['sequencer']} - {None, server_address}:
         try:
-            tcp_transmit_message(command, contents, client)
+            tcp_transmit_message('ROOM', update, server)
         except (ConnectionRefusedError, TimeoutError):
-            print(f'Unable to send to {client}')
-            ping_clients(client)
+            log.warning('Unable to send to %s', server)
+    message_to_servers('ROOM', update)
+    if old_room is not None:
+        message_to_room(old_room, 'SERV', f'{address[0]} has left the room')
+    transmit_room(room, address)
+    message_to_room(room, 'SERV', f'{address[0]} has joined the room')
+
+
+# Puts the client in the room, and takes it out of the room it was in
+# group, sequencer and clock are the room's group address, sequencer and clock when it was created
+# They are picked here if the room is new and we weren't told, which only happens on the leader
+def move_client(address, room, group=None, sequencer=None, clock=0):
+    if room not in multicast_groups:
+        is_picked_here = group is None
+        if is_picked_here:
+            group = utility.room_group(room, [existing['address'] for existing in multicast_groups.values()])
+            sequencer = assign_room()
+        log.info('Creating room %s with group %s, sequenced by %s', room, group, sequencer)
+        new_group = add_multicast_group(room, tuple(group), clients=set(), clock=clock, sequencer=tuple(sequencer))
+        if is_picked_here:
+            resume_clock(new_group)
+    remove_client_from_room(address)
+    multicast_groups[room]['clients'].add(address)
+    clients.set(address, room=room)
+
+
+# Carries on from the last clock value in the room's log, so that a room used before every server stopped
+# doesn't hand out clock values that are already in its log
+def resume_clock(group):
+    if group['log'] is not None and group['log'].last_clock > group['clock'][0]:
+        group['clock'][0] = group['log'].last_clock
+        group['hold_back'].set_clock(group['clock'][0])
+
+
+def remove_client_from_room(address):
+    room = clients.get(address, 'room')
+    if room is not None:
+        clients.set(address, room=None)
+        multicast_groups[room]['clients'].discard(address)
 
 
-# If a specific client is provided, ping that client
-# Otherwise ping all clients
-def ping_clients(client_to_ping=None):
-    if client_to_ping:
-        to_ping = [client_to_ping]
-    else:
-        to_ping = clients
+"""
+Client ownership
+The leader hands every new client to the server with the fewest clients, and that server handles everything
+the client sends. Membership changes are passed on to the leader, chats to the sequencer of the client's room
+Each room has one sequencer, the server with the fewest rooms when the room was created, which multicasts
+everything in the room. A room therefore keeps its total order, and rooms are spread over the servers
+When a server is gone, the leader hands its clients and rooms to the other servers
+"""
+
+
+# Returns the server with the fewest entries in assigned, which has one entry per client or room a server has
+# Servers that are still being sent the state are only picked if there are no others, and so is the excluded server
+def least_loaded_server(assigned, excluded=None):
+    load = {server: 0 for server in servers}
+    for server in assigned:
+        if server in load:
+            load[server] += 1
+    candidates = ([server for server in servers if server not in syncing_servers and server != excluded]
+                  or [server for server in servers if server != excluded] or servers)
+    return min(candidates, key=lambda server: (load[server], server))
+
+
+def assign_client(address):
+    return least_loaded_server(clients.values('owner'))
+
+
+def assign_room():
+    return least_loaded_server(group['sequencer'] for group in multicast_groups.values())
+
 
-    for client in to_ping:
+# Hands the clients and rooms of servers that are no longer in the server list to the remaining servers
+# Only called on the leader
+def reassign_orphans():
+    owners = {}
+    for client, owner in clients.items('owner'):
+        if owner not in servers:
+            owners[client] = assign_client(client)
+            clients.set(client, owner=owners[client])
+    sequencers = {}
+    for name, group in list(multicast_groups.items()):
+        if group['clients'] is not None and group['sequencer'] not in servers:
+            sequencers[name] = group['sequencer'] = assign_room()
+    if not owners and not sequencers:
+        return
+
+    log.info('Reassigning %s clients and %s rooms', len(owners), len(sequencers))
+    metrics.count('reassigned.clients', len(owners))
+    metrics.count('reassigned.rooms', len(sequencers))
+    message_to_servers('OWNER', {'clients': owners, 'rooms': sequencers})
+    apply_owners(owners, sequencers)
+    for client, owner in owners.items():
         try:
-            tcp_transmit_message('PING', '', client)
-        except (ConnectionRefusedError, TimeoutError):  # If we can't connect to a client, then drop it
-            print(f'Failed send to {client}')
-            print(f'Removing {client} from clients')
-            try:
-                clients.remove(client)
-                message_to_servers('QUIT', format_join_quit('client', False, client))
-                message_to_clients('SERV', f'{client[0]} is unreachable')
-            except ValueError:
-                print(f'{client} was not in clients')
+            transmit_assignment(owner, client)
+        except (ConnectionRefusedError, TimeoutError):
+            log.warning('Unable to send to %s', client)
+
+
+# Clients handed to us get a fresh lease, as they only start renewing it with us once they've been told
+def apply_owners(owners, sequencers):
+    for client, owner in owners.items():
+        clients.set(client, owner=owner)
+        if owner == server_address:
+            clients.touch(client)
+    for name, sequencer in sequencers.items():
+        group = multicast_groups.get(name)
+        if group is None:
+            continue
+        # The room's multicasts come from us now, once we have everything the old sequencer multicast
+        # The recovery starts before the room is ours, so that no chat is sequenced before it
+        if sequencer == server_address and group['sequencer'] != server_address:
+            recover_group(name)
+        group['sequencer'] = sequencer
+        reroute(name)
+
+
+# Takes over multicasting to a group from a server that is gone, see REPLICATION_QUORUM
+# Every other server is asked for the messages of the group it has after the last one we delivered
+# Multicasts to the group are held back until they have all answered, or RECOVERY_TIMEOUT has passed
+def recover_group(name):
+    group = multicast_groups[name]
+    hold_back = group['hold_back']
+    if hold_back.clock is None:
+        hold_back.set_clock(group['clock'][0])
+    others = [server for server in servers if server != server_address]
+    recovery = {'waiting': set(others), 'asked': len(others), 'parked': [], 'clock': hold_back.clock,
+                'started': monotonic()}
+    with recovery_lock:
+        group['recovery'] = recovery
+    if others:
+        log.info('Recovering %s from clock %s', name, hold_back.clock + 1)
+        results = tcp_fan_out('SYNC', {'list': name, 'clock': hold_back.clock + 1}, others)
+        recovery['waiting'] -= {server for server, error in results.items() if error is not None}
+    if recovery['waiting']:
+        run_in_background(finish_recovery, name, recovery, delay=RECOVERY_TIMEOUT)
+    else:
+        finish_recovery(name, recovery)
+
+
+# Stores the messages a server had of a group we are taking over. Answers that come too late are ignored,
+# as we may have multicast with their clock values since
+def receive_sync(name, messages, address):
+    group = multicast_groups.get(name)
+    recovery = group and group['recovery']
+    if not recovery or address not in recovery['waiting']:
+        return
+    for data in messages:
+        hold_back_multicast(data, decode_message(data), name)
+    recovery['waiting'].discard(address)
+    if not recovery['waiting']:
+        finish_recovery(name, recovery)
+
+
+# Carries on from the highest clock value of the group any server had, and sends the multicasts that waited
+# Anything still held back behind a gap is missing on every server, so it is delivered as it is
+# Delivering what was held back can multicast to the group, which then waits with the rest
+def finish_recovery(name, recovery):
+    group = multicast_groups[name]
+    if group['recovery'] is not recovery:
+        return
+    hold_back = group['hold_back']
+    hold_back.flush()
+    with recovery_lock:
+        if group['recovery'] is not recovery:
+            return
+        group['clock'][0] = max(group['clock'][0], hold_back.clock, group['history'].last_clock)
+        hold_back.set_clock(group['clock'][0])
+        group['recovery'] = None
+        for command, contents, count in recovery['parked']:
+            multicast_pipeline.submit(name, command, contents, name, count)
+
+    if not recovery['asked']:
+        return
+    if recovery['waiting']:
+        log.warning('%s servers did not answer in time while recovering %s', len(recovery['waiting']), name)
+        metrics.count('replication.recovery_timeouts')
+    recovered = group['clock'][0] - recovery['clock']
+    log.info('Recovered %s up to clock %s, %s more than we had', name, group['clock'][0], recovered)
+    metrics.count('replication.recoveries')
+    metrics.count('replication.recovered', recovered)
+    metrics.observe('replication.recovery_seconds', monotonic() - recovery['started'])
+
+
+# Tells a client which server to use, and every server there is, to reconnect to if that one is gone
+# It is also told its own id, to recognise its own chats by
+def transmit_assignment(owner, address, sender_id=None):
+    sender_id = clients.get(address, 'id') if sender_id is None else sender_id
+    tcp_transmit_message('ASSIGN', {'server': owner, 'servers': list(servers), 'id': sender_id}, address)
+
+
+# A client that reconnected only has to be told its server again if the chatroom still has it
+# If that is the server it couldn't reach, it is handed to another one straight away, without waiting for the server
+# to be found gone. Otherwise its lease ran out while it was away, so it joins again, straight into the room it was in
+# Only called on the leader
+def rejoin_client(address, room, lost_server):
+    log.info('Client %s reconnected', address)
+    metrics.count('clients.reconnected')
+    if address in clients:
+        owner = clients.get(address, 'owner')
+        if owner == lost_server or owner not in servers:
+            owner = least_loaded_server(clients.values('owner'), excluded=lost_server)
+            message_to_servers('OWNER', {'clients': {address: owner}, 'rooms': {}})
+            apply_owners({address: owner}, {})
+        transmit_assignment(owner, address)
+        return
+    owner = assign_client(address)
+    sender_id = new_sender_id()
+    message_to_servers('JOIN', format_join_quit('client', False, address) | {'owner': owner, 'id': sender_id})
+    clients.add(address, owner=owner, id=sender_id)
+    move_client(address, utility.DEFAULT_ROOM)
+    message_to_room(utility.DEFAULT_ROOM, 'SERV', f'{address[0]} has joined the chat')
+    announce_sender(address, sender_id)
+    transmit_assignment(owner, address)
+    change_room(address, room)
+
+
+# Passes a request from a client or a new server on to the leader, as if the node had sent it there itself
+def forward_to_leader(message):
+    try:
+        utility.tcp_transmit_message(encode_message(message['command'], message['sender'], message['contents']),
+                                     leader_address)
+    except (ConnectionRefusedError, TimeoutError):
+        log.warning('Unable to forward %s to the leader at %s', message['command'], leader_address)
+
+
+# Tells a client which room it is in, which group to listen to and the room's clock
+# With SENDER_IDS, it is also sent the id of every client, to tell who sent the chats in the room
+def transmit_room(room, address):
+    group = multicast_groups[room]
+    contents = {'room': room, 'group': group['address'], 'clock': group['clock']}
+    if SENDER_IDS:
+        contents['senders'] = {sender_id: client for client, sender_id in clients.items('id')}
+    tcp_transmit_message('ROOM', contents, address)
+
+
+# Sends message to all clients
+def tcp_msg_to_clients(command, contents=''):
+    ping_clients(list(clients), command, contents)
+
+
+# If a list of clients is provided, ping those clients
+# Otherwise ping all clients
+# Another command can be sent in place of the ping
+# A client that can't be reached loses its lease if we own it, so it is removed with the next expired leases
+# Clients owned by other servers are left to their leases with those servers
+def ping_clients(to_ping=None, command='PING', contents=''):
+    if to_ping is None:
+        to_ping = list(clients)
+
+    for client, error in tcp_fan_out(command, contents, to_ping).items():
+        if error is not None:
+            client_unreachable(client)
+
+
+def client_unreachable(address):
+    log.warning('Failed send to %s', address)
+    metrics.count('clients.unreachable')
+    if clients.get(address, 'owner') == server_address:
+        clients.set(address, last_seen=float('-inf'))
 
 
 def tcp_transmit_message(command, contents, address):
-    if command != 'PING':
-        print(f'Sending command {command} to {address}')
+    if command not in ('PING', 'PONG'):
+        log.debug('Sending command %s to %s', command, address)
     message_bytes = encode_message(command, server_address, contents)
     utility.tcp_transmit_message(message_bytes, address)
 
 
+# Sends the message to every address at once, see utility.tcp_fan_out. It is only encoded once
+# Returns None for every address it was sent to, and the error for the others
+def tcp_fan_out(command, contents, addresses):
+    log.debug('Sending command %s to %s nodes', command, len(addresses))
+    return utility.tcp_fan_out(encode_message(command, server_address, contents), addresses)
+
+
 """
 Voting is implemented with the find_neighbor, start_voting, and set_leader functions
-The voting algorithm is the LaLann-Chang-Roberts algorithm
+The voting algorithm is the LaLann-Chang-Roberts algorithm, or the bully algorithm with --election bully
 """
 
 
@@ -465,17 +1649,17 @@ The voting algorithm is the LaLann-Chang-Roberts algorithm
 # Our neighbor is the server with the next highest address
 # The neighbors are used for crash fault tolerance
 # and to arrange the servers in a virtual ring for voting
+# A new neighbor is watched from scratch, as heartbeats from when it last was our neighbor say nothing about it now
 def find_neighbor():
     global neighbor
-    length = len(servers)
-    if length == 1:
-        neighbor = None
-        print('I have no neighbor')
-        return
-    servers.sort()
-    index = servers.index(server_address)
-    neighbor = servers[0] if index + 1 == length else servers[index + 1]
-    print(f'My neighbor is {neighbor}')
+    new_neighbor = servers.next_after(server_address)
+    if new_neighbor != neighbor and new_neighbor is not None:
+        failure_detector.remove(new_neighbor)
+    neighbor = new_neighbor
+    if neighbor is None:
+        log.info('I have no neighbor')
+    else:
+        log.info('My neighbor is %s', neighbor)
 
 
 # Starts voting by setting is_voting to true and sending a vote to neighbor
@@ -488,25 +1672,315 @@ def vote(address=server_address):
         set_leader(server_address)
         return
     global is_voting
+    if election_started[0] is None:
+        election_started[0] = monotonic()
+        metrics.count('elections')
+    if ELECTION_MODE == 'bully':
+        bully_vote()
+        return
     vote_for = max(address, server_address)
     if vote_for != server_address or not is_voting:
         tcp_transmit_message('VOTE', {'vote_for': vote_for, 'leader_elected': False}, neighbor)
     is_voting = True
 
 
+# Sends our vote to every server with a higher address. If none of them can be reached, we are the leader
+# Otherwise the highest one that is still there wins, as each of them votes the same way when the vote reaches it
+# As the servers are known, that takes a round of votes and one of telling everyone, however many servers there are
+# Votes while we are already voting are only sent again once ELECTION_TIMEOUT has passed, see check_election
+def bully_vote():
+    global is_voting
+    if is_voting:
+        return
+    higher = [server for server in servers if server > server_address]
+    delivered = 0
+    for server in higher:
+        try:
+            tcp_transmit_message('VOTE', {'vote_for': server_address, 'leader_elected': False}, server)
+            delivered += 1
+        except (ConnectionRefusedError, TimeoutError):
+            log.warning('Unable to send vote to %s', server)
+    metrics.count('election.votes', delivered)
+    if not delivered:
+        set_leader(server_address)
+        return
+    is_voting = True
+    run_in_background(check_election, election_started[0], delay=ELECTION_TIMEOUT)
+
+
+# Votes again if the election started at started is still going, because the servers we voted for went down before
+# telling us who won
+def check_election(started):
+    global is_voting
+    if not is_voting or election_started[0] != started:
+        return
+    log.warning('No leader after %s seconds, voting again', ELECTION_TIMEOUT)
+    metrics.count('election.timeouts')
+    is_voting = False
+    vote()
+
+
 def set_leader(address):
     global leader_address, is_leader, is_voting
     leader_address = address
     is_leader = leader_address == server_address
     is_voting = False
+    if election_started[0] is not None:
+        metrics.observe('election_seconds', monotonic() - election_started[0])
+        election_started[0] = None
     if is_leader:
-        print('I am the leader')
+        log.info('I am the leader')
+        # The leader sends the multicasts to the servers, so its server clock is the one everyone follows
+        # It carries on from the last change to the state any server has, see recover_group
+        # The rooms of the old leader are handed out before anything is sent to them
+        # Without a clock from another server, the chatroom is starting (again), and the rooms carry on from their logs
+        hold_back = multicast_groups['server']['hold_back']
+        if hold_back.clock is None:
+            hold_back.set_clock(multicast_groups['server']['clock'][0])
+            for group in multicast_groups.values():
+                resume_clock(group)
+        recover_group('server')
+        reassign_orphans()
         message_to_clients('LEAD')
-        if neighbor:
-            tcp_transmit_message('VOTE', {'vote_for': server_address, 'leader_elected': True}, neighbor)
+        announce_leader()
     else:
-        print(f'The leader is {leader_address}')
+        log.info('The leader is %s', leader_address)
+
+
+# Tells the other servers that we are the leader, around the ring or with bully elections, to each of them directly
+def announce_leader():
+    if ELECTION_MODE == 'bully':
+        tcp_msg_to_servers('VOTE', {'vote_for': server_address, 'leader_elected': True})
+    elif neighbor:
+        tcp_transmit_message('VOTE', {'vote_for': server_address, 'leader_elected': True}, neighbor)
+
+
+"""
+The asyncio runtime replaces the listener and heartbeat threads with coroutines on a single event loop
+It is started with: python server.py --asyncio
+
+All network reads and the heartbeat timer run on the loop, so shutting down is immediate instead of waiting
+for the 2 second socket timeouts, and every client connection is a coroutine rather than a thread
+Everything that changes the server's state (server_command, receive_multicast, remove_neighbor and with it the election)
+runs on command_executor, which has a single thread. Handlers therefore never run at the same time,
+and the sends they make don't block the loop
+Commands received over tcp go through command_workers, as with threads, and only wait for command_executor
+if they change the state
+"""
+
+
+async def async_main():
+    global event_loop, shutdown_event, command_executor, datagram_transport
+    event_loop = asyncio.get_running_loop()
+    shutdown_event = asyncio.Event()
+    command_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='command')
+
+    utility.cls()
+    multicast_pipeline.start()
+    command_workers.start()
+    add_multicast_group('server', utility.MG_SERVER)
+    add_multicast_group(utility.DEFAULT_ROOM, utility.MG_CLIENT, clients=set())
+    await run_command(startup)
+    log.info('Server up and running at %s', server_address)
+
+    transports = multicast_transports
+    transport, _ = await event_loop.create_datagram_endpoint(
+        BroadcastProtocol, sock=utility.setup_broadcast_listener_socket())
+    transports.append(transport)
+
+    transport, _ = await event_loop.create_datagram_endpoint(AckProtocol, sock=multicast_socket)
+    transports.append(transport)
+    datagram_transport, _ = await event_loop.create_datagram_endpoint(UnicastProtocol, sock=datagram_socket)
+    transports.append(datagram_transport)
+    lease_reaper_task = asyncio.create_task(async_lease_reaper())
+    expire_acks_task = asyncio.create_task(async_expire_pending_acks())
+    check_gaps_task = asyncio.create_task(async_check_gaps())
+
+    connections = {}  # Handler task for each open connection, mapped to the connection's writer
+    tcp_server = await asyncio.start_server(
+        lambda reader, writer: async_tcp_connection_handler(reader, writer, connections), sock=server_socket)
+    heartbeat_task = asyncio.create_task(async_heartbeat())
+
+    await shutdown_event.wait()
+
+    log.info('Event loop closing')
+    tcp_server.close()
+    heartbeat_task.cancel()
+    expire_acks_task.cancel()
+    check_gaps_task.cancel()
+    lease_reaper_task.cancel()
+    # Closing the connections ends their handlers once they've handed on the message they're on
+    for writer in list(connections.values()):
+        writer.close()
+    for transport in transports:
+        transport.close()
+    await asyncio.gather(heartbeat_task, expire_acks_task, check_gaps_task, lease_reaper_task, *connections,
+                         return_exceptions=True)
+    await asyncio.to_thread(command_workers.join)
+    command_executor.shutdown(wait=True)
+    utility.close_tcp_connections()
+
+
+# Runs a state changing function on the command thread
+def run_command(function, *args):
+    return event_loop.run_in_executor(command_executor, function, *args)
+
+
+# Logs errors from handlers that nobody is waiting for
+def log_command_error(future):
+    if not future.cancelled() and future.exception():
+        log.error('Error handling command: %r', future.exception())
+
+
+class BroadcastProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        response = broadcast_response(data, address)
+        if response:
+            self.transport.sendto(response, address)
+
+
+# Listens to a multicast group. Started by add_multicast_group, which can be called from any thread
+async def async_multicast_listener(name):
+    listener_socket = utility.setup_multicast_listener_socket(multicast_groups[name]['address'])
+    transport, _ = await event_loop.create_datagram_endpoint(partial(MulticastProtocol, name), sock=listener_socket)
+    multicast_transports.append(transport)
+
+
+class MulticastProtocol(asyncio.DatagramProtocol):
+    def __init__(self, name):
+        self.name = name
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        # Acks are sent from the command thread, so they have to be handed back to the loop
+        def send_ack(ack):
+            event_loop.call_soon_threadsafe(self.transport.sendto, ack, address)
+        run_command(receive_multicast, data, self.name, send_ack).add_done_callback(log_command_error)
+
+
+class AckProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, address):
+        receive_ack(data)
+
+
+class UnicastProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        receive_datagram(data, lambda reply: self.transport.sendto(reply, address))
+
+
+async def async_expire_pending_acks():
+    while True:
+        await asyncio.sleep(ACK_TIMEOUT / 4)
+        expire_pending_acks()
+
+
+async def async_lease_reaper():
+    while True:
+        await asyncio.sleep(LEASE_CHECK_INTERVAL)
+        await run_command(expire_leases)
+
+
+# NACKs gaps again that haven't been filled, like the multicast listener threads do when they time out
+async def async_check_gaps():
+    while True:
+        await asyncio.sleep(NACK_RETRY)
+        for group in list(multicast_groups.values()):
+            await run_command(group['hold_back'].check_gap)
+
+
+# Reads every message sent over a connection
+# Waiting for each command to be handled keeps the messages from one connection in order
+# and stops a fast sender from queueing up unlimited work
+async def async_tcp_connection_handler(reader, writer, connections):
+    task = asyncio.current_task()
+    connections[task] = writer
+    try:
+        while True:
+            header = await reader.readexactly(utility.FRAME_HEADER.size)
+            data = await reader.readexactly(utility.FRAME_HEADER.unpack(header)[0])
+            try:
+                # Waiting for room in a full queue is done off the loop
+                if not receive_tcp_message(data, block=False):
+                    await asyncio.to_thread(receive_tcp_message, data)
+            except Exception as e:
+                log.error('Error handling command: %r', e)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        connections.pop(task, None)
+        writer.close()
+
+
+# Pings the neighbor every HEARTBEAT_INTERVAL seconds, like heartbeat
+async def async_heartbeat():
+    while is_active:
+        watched = neighbor
+        if watched and ping_neighbor(watched):
+            await run_command(remove_neighbor, watched)
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Chatroom server')
+    parser.add_argument('--asyncio', action='store_true', help='run the listeners as coroutines on one event loop')
+    parser.add_argument('--leader', action='store_true', help='start as the leader without looking for other servers')
+    parser.add_argument('--join', metavar='IP:PORT', help='join the server at this address without broadcasting')
+    parser.add_argument('--batch-window', type=float, default=CHAT_BATCH_WINDOW,
+                        help='seconds to collect chats for before multicasting them together, 0 to turn off')
+    parser.add_argument('--wire-format', choices=('repr', 'binary'), default=utility.WIRE_FORMAT)
+    parser.add_argument('--compress', action='store_true', help='compress messages with a dictionary of common ones')
+    parser.add_argument('--sender-ids', action='store_true',
+                        help='send the ids of the clients in chats instead of their addresses')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='seconds between heartbeats to the neighbor')
+    parser.add_argument('--phi-threshold', type=float, default=PHI_THRESHOLD,
+                        help='how sure a server has to be that its neighbor is gone before removing it')
+    parser.add_argument('--election', choices=('ring', 'bully'), default=ELECTION_MODE,
+                        help='how the servers elect a leader, every server has to use the same')
+    parser.add_argument('--command-workers', type=int, default=COMMAND_WORKERS,
+                        help='threads handling the commands received over tcp')
+    parser.add_argument('--send-window', type=int, default=SEND_WINDOW,
+                        help='most sends of missed multicasts that can be going to one client at once')
+    parser.add_argument('--replication-quorum', type=int, default=REPLICATION_QUORUM,
+                        help='other servers that have to store a multicast before it is committed')
+    parser.add_argument('--laggard-policy', choices=('drop', 'replay', 'disconnect'), default=LAGGARD_POLICY,
+                        help='what to do with a client that stopped acking multicasts')
+    parser.add_argument('--log-dir', metavar='DIR', help='write the messages of every room to a log in this directory')
+    parser.add_argument('--log-sync', action='store_true', help='flush every logged message to the disk')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO',
+                        help='DEBUG logs every command and multicast')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    main()
+    arguments = parse_arguments()
+    logging.basicConfig(stream=sys.stdout, format='%(message)s', level=arguments.log_level)
+    join_address = utility.parse_address(arguments.join) if arguments.join else None
+    start_as_leader = arguments.leader
+    CHAT_BATCH_WINDOW = arguments.batch_window
+    LOG_DIR = arguments.log_dir
+    HEARTBEAT_INTERVAL = arguments.heartbeat_interval
+    PHI_THRESHOLD = arguments.phi_threshold
+    ELECTION_MODE = arguments.election
+    failure_detector = PhiAccrualDetector(HEARTBEAT_INTERVAL)
+    LOG_SYNC = arguments.log_sync
+    utility.WIRE_FORMAT = arguments.wire_format
+    utility.COMPRESSION = arguments.compress
+    SENDER_IDS = arguments.sender_ids
+    send_windows = SendWindows(arguments.send_window)
+    command_workers = WorkerPool(arguments.command_workers, COMMAND_QUEUE_SIZE, name='dispatch')
+    LAGGARD_POLICY = arguments.laggard_policy
+    REPLICATION_QUORUM = arguments.replication_quorum
+
+    if arguments.asyncio:
+        asyncio.run(async_main())
+    else:
+        main()
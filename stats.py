@@ -0,0 +1,49 @@
+#!/usr/bin/env python3.10
+
+"""
+Prints the metrics of a running server without joining the chatroom
+
+Sends the server a STATS command and waits for its reply on a listener of our own
+The same stats can be shown from a client with the #STATS command
+
+Usage: python stats.py IP:PORT [--json]
+"""
+
+import argparse
+import json
+import socket
+
+from utility import encode_message, decode_message
+from metrics import format_stats
+import utility
+
+
+# Returns the stats dict the server at address replies with
+def request_stats(address, timeout=5):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind((utility.get_ip(), 0))
+        listener.listen()
+        listener.settimeout(timeout)
+        utility.tcp_transmit_message(encode_message('STATS', listener.getsockname(), ''), address)
+        connection, _ = listener.accept()
+        for data in utility.receive_tcp_messages(connection, lambda: True):
+            return decode_message(data)['contents']
+    raise ConnectionError(f'{address} closed the connection without replying')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the metrics of a chatroom server')
+    parser.add_argument('server', metavar='IP:PORT')
+    parser.add_argument('--json', action='store_true', help='print the raw stats as JSON')
+    arguments = parser.parse_args()
+
+    stats = request_stats(utility.parse_address(arguments.server))
+    utility.close_tcp_connections()
+    if arguments.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print('\n'.join(format_stats(stats)))
+
+
+if __name__ == '__main__':
+    main()
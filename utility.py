@@ -4,6 +4,14 @@ import socket
 import os
 import struct
 import ast
+import select
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+
+import codec
+from metrics import metrics
 
 # Constants
 # By changing the port numbers, there can be more than one chat on a network
@@ -11,6 +19,8 @@ BROADCAST_PORT = 10001
 ML_SERVER_PORT = 10002
 ML_CLIENT_PORT = 10003
 BUFFER_SIZE = 4096
+# Largest payload that fits in a single UDP datagram, multicast listeners read this much
+MAX_DATAGRAM_SIZE = 65507
 # Random code to broadcast / listen for to filter out other network traffic
 BROADCAST_CODE = '9310e231f20a07cb53d96b90a978163d'
 # Random code to respond with
@@ -22,6 +32,39 @@ SERVER_BROADCAST_ATTEMPTS = 5
 # Choices are arbitrary for now
 MG_SERVER = ('224.3.100.255', ML_SERVER_PORT)
 MG_CLIENT = ('224.3.200.255', ML_CLIENT_PORT)
+# Clients start out in this chat room, which uses MG_CLIENT. Every other room gets a group of its own, see room_group
+DEFAULT_ROOM = 'lobby'
+MAX_ROOM_NAME = 64
+# The ip address and tcp port nodes listen on can be set with the CHATROOM_IP and CHATROOM_PORT environment variables
+# Setting the ip to 127.0.0.1 runs everything on one machine without touching the network (see benchmark.py)
+# Multicasts are then also sent and received on that interface only
+INTERFACE_IP = os.environ.get('CHATROOM_IP')
+LISTENER_PORT = int(os.environ.get('CHATROOM_PORT', 0))
+# Format used to encode messages, either 'repr' or 'binary' (see codec.py)
+# Messages in either format can always be decoded, so nodes using different formats can still talk to each other
+WIRE_FORMAT = 'repr'
+# Messages of at least COMPRESS_MIN_SIZE bytes are compressed if COMPRESSION is set and that makes them smaller
+# Compressed messages can always be decoded too, so only the senders need to have it set
+COMPRESSION = False
+COMPRESS_MIN_SIZE = 48
+# Pooled tcp connections that haven't been used for this many seconds are closed
+IDLE_CONNECTION_TIMEOUT = 30
+# Every message sent over tcp is prefixed with its length as a 4 byte unsigned int
+# This lets many messages share one connection and lets a message be any size
+FRAME_HEADER = struct.Struct('!I')
+
+# A fan out sends to many peers at once on at most FAN_OUT_CONCURRENCY threads, which every fan out shares
+# It gives up on the sends that haven't finished after FAN_OUT_DEADLINE seconds, see tcp_fan_out
+FAN_OUT_CONCURRENCY = 32
+FAN_OUT_DEADLINE = 2.5
+fan_out_executor = [None]
+fan_out_lock = threading.Lock()
+
+# Pool of outgoing tcp connections, keyed by peer address
+# Each entry is [socket, lock, time of last use]. The lock keeps two threads from interleaving messages on one socket
+tcp_connections = {}
+tcp_connections_lock = threading.Lock()
+last_idle_sweep = [monotonic()]
 
 
 # Function to get the ip address of the computer running the program
@@ -29,6 +72,8 @@ MG_CLIENT = ('224.3.200.255', ML_CLIENT_PORT)
 # when you have more than one network adapter, or when 127.0.0.1 is saved in your hosts file in Linux
 # Source: https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib
 def get_ip():
+    if INTERFACE_IP:
+        return INTERFACE_IP
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         # doesn't even have to be reachable
@@ -41,13 +86,201 @@ def get_ip():
     return IP
 
 
-# Sends tcp messages by opening a new socket, connecting, sending the message, and then closing the socket
+# Sends tcp messages over a pooled connection to the address
+# A connection is only opened if there is no usable one in the pool
+# If sending over a pooled connection fails, the connection is reopened once before giving up
+# Raises ConnectionRefusedError / TimeoutError if the peer can't be reached, just like a fresh connect would
 def tcp_transmit_message(message, address):
+    address = tuple(address)
+    with tcp_connections_lock:
+        connection = tcp_connections.setdefault(address, [None, threading.Lock(), monotonic()])
+
+    with connection[1]:
+        for attempt in range(2):
+            if connection[0] is None or is_stale_connection(connection[0]):
+                close_pooled_socket(connection)
+                connection[0] = open_tcp_connection(address)
+                metrics.count('tcp.connections_opened')
+            try:
+                send_frame(connection[0], message)
+            except OSError:
+                close_pooled_socket(connection)
+                metrics.count('tcp.send_failures')
+                if attempt:
+                    raise
+            else:
+                connection[2] = monotonic()
+                metrics.count('tcp.messages_sent')
+                metrics.count('tcp.bytes_sent', len(message))
+                break
+
+    if monotonic() - last_idle_sweep[0] > IDLE_CONNECTION_TIMEOUT:
+        close_idle_connections()
+
+
+# Sends the same message to every address over tcp, all at once rather than one after the other
+# So sending to many peers takes about as long as the slowest one, and at most deadline seconds
+# Returns the result of each send by address: None if it was sent, otherwise the error it failed with
+# Sends still going at the deadline carry on in the background, and are reported as a TimeoutError
+def tcp_fan_out(message, addresses, deadline=None):
+    addresses = list(dict.fromkeys(tuple(address) for address in addresses))
+    deadline = FAN_OUT_DEADLINE if deadline is None else deadline
+    if len(addresses) == 1:  # Not worth handing to another thread
+        return {addresses[0]: try_transmit_message(message, addresses[0])}
+
+    start = monotonic()
+    executor = get_fan_out_executor()
+    try:
+        futures = {executor.submit(tcp_transmit_message, message, address): address for address in addresses}
+    except RuntimeError:  # The interpreter is shutting down, and the executor with it
+        return {address: try_transmit_message(message, address) for address in addresses}
+    _, not_done = wait(futures, timeout=deadline)
+    results = {}
+    for future, address in futures.items():
+        if future in not_done:
+            future.cancel()
+            results[address] = TimeoutError(f'Send to {address} took longer than {deadline} seconds')
+        else:
+            results[address] = future.exception()
+    metrics.count('fan_out.sends', len(addresses))
+    metrics.count('fan_out.failures', sum(result is not None for result in results.values()))
+    metrics.observe('fan_out.seconds', monotonic() - start)
+    return results
+
+
+# Returns None if the message was sent, otherwise the error it failed with
+def try_transmit_message(message, address):
+    try:
+        tcp_transmit_message(message, address)
+    except OSError as e:
+        return e
+    return None
+
+
+# The threads are only started once something fans out, so nodes that never do don't have them
+def get_fan_out_executor():
+    with fan_out_lock:
+        if fan_out_executor[0] is None:
+            fan_out_executor[0] = ThreadPoolExecutor(FAN_OUT_CONCURRENCY, thread_name_prefix='fan-out')
+        return fan_out_executor[0]
+
+
+def open_tcp_connection(address):
     transmit_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     transmit_socket.settimeout(1)
-    transmit_socket.connect(address)
-    transmit_socket.send(message)
-    transmit_socket.close()
+    try:
+        transmit_socket.connect(address)
+    except OSError:
+        transmit_socket.close()
+        raise
+    transmit_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return transmit_socket
+
+
+# Pooled connections are only ever written to, so if the socket is readable the peer has closed or reset it
+def is_stale_connection(transmit_socket):
+    readable, _, _ = select.select([transmit_socket], [], [], 0)
+    return bool(readable)
+
+
+def close_pooled_socket(connection):
+    if connection[0] is not None:
+        connection[0].close()
+        connection[0] = None
+
+
+# Closes pooled connections which haven't been used recently
+# Connections that are busy sending are skipped, they'll be picked up by the next sweep
+def close_idle_connections(max_idle=IDLE_CONNECTION_TIMEOUT):
+    last_idle_sweep[0] = monotonic()
+    with tcp_connections_lock:
+        for address, connection in list(tcp_connections.items()):
+            if last_idle_sweep[0] - connection[2] > max_idle and connection[1].acquire(blocking=False):
+                close_pooled_socket(connection)
+                del tcp_connections[address]
+                connection[1].release()
+
+
+# Closes every pooled connection. Used at shutdown
+def close_tcp_connections():
+    close_idle_connections(max_idle=-1)
+
+
+# Sends the length header followed by the message
+# Large messages are sent straight after the header so they don't get copied just to prepend 4 bytes
+def send_frame(transmit_socket, message):
+    header = FRAME_HEADER.pack(len(message))
+    if len(message) < BUFFER_SIZE:
+        transmit_socket.sendall(header + message)
+    else:
+        transmit_socket.sendall(header)
+        transmit_socket.sendall(message)
+
+
+# Reads every message sent over an accepted tcp connection until the peer closes it
+# is_active is called between reads so that the listener can be stopped
+# Small messages are reassembled in one reusable buffer, so a single recv can pick up several of them
+# A message too big for that buffer gets a buffer of its own, and the rest of it is read straight into that
+def receive_tcp_messages(connection, is_active):
+    connection.settimeout(2)
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    start = end = 0  # buffer[start:end] holds the bytes which haven't been handed out yet
+
+    with connection:
+        while True:
+            # Hand out every complete message already in the buffer
+            length = None
+            while end - start >= FRAME_HEADER.size:
+                length = FRAME_HEADER.unpack_from(buffer, start)[0]
+                message_start = start + FRAME_HEADER.size
+                if message_start + length > end:
+                    break
+                yield bytes(view[message_start:message_start + length])
+                start = message_start + length
+                length = None
+
+            if length is not None and FRAME_HEADER.size + length > BUFFER_SIZE:
+                message = bytearray(length)
+                received = end - message_start
+                message[:received] = view[message_start:end]
+                message_view = memoryview(message)
+                while received < length:
+                    count = receive_into(connection, message_view[received:], is_active)
+                    if not count:
+                        return
+                    received += count
+                yield message
+                start = end = 0
+                continue
+
+            # Move the start of the next message to the front of the buffer and read in after it
+            if start:
+                buffer[:end - start] = bytes(view[start:end])
+                start, end = 0, end - start
+            count = receive_into(connection, view[end:], is_active)
+            if not count:
+                return
+            end += count
+
+
+# Reads whatever is available into the view
+# Returns 0 if the connection was closed or the listener was stopped
+def receive_into(connection, view, is_active):
+    while is_active():
+        try:
+            return connection.recv_into(view)
+        except TimeoutError:
+            continue
+        except OSError:
+            return 0
+    return 0
+
+
+# Turns 'ip:port' from the command line into an address tuple
+def parse_address(text):
+    ip, port = text.rsplit(':', 1)
+    return ip, int(port)
 
 
 # Clears the console. Used at program launch
@@ -59,11 +292,25 @@ def cls():
 # Create TCP socket for listening to unicast messages
 def setup_tcp_listener_socket():
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((get_ip(), 0))
+    s.bind((get_ip(), LISTENER_PORT))
     s.listen()
     return s
 
 
+# Create UDP socket for datagrams sent straight to a node, on the same address as its TCP listener
+def setup_udp_listener_socket(address):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(address)
+    return s
+
+
+# Create UDP socket for sending datagrams straight to another node
+def setup_udp_sender_socket():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((get_ip(), 0))
+    return s
+
+
 # Create UDP socket for listening to broadcasted messages
 def setup_udp_broadcast_socket(timeout=None):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # create UDP socket
@@ -74,28 +321,138 @@ def setup_udp_broadcast_socket(timeout=None):
     return s
 
 
+# Create UDP socket for listening to broadcasts on the broadcast port
+# The port can be shared, so that more than one server can run on a computer
+def setup_broadcast_listener_socket():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(('', BROADCAST_PORT))
+    return s
+
+
 # Create UDP socket for listening to multicasted messages
+# The port can be shared, so that more than one node can run on a computer
 # Understanding of / concept for the multicast functions from here:
 # https://pymotw.com/3/socket/multicast.html
 def setup_multicast_listener_socket(group):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     # s.bind(('', group[1]))
     s.bind(group)
 
     group = socket.inet_aton(group[0])
-    mreq = struct.pack('4sL', group, socket.INADDR_ANY)
+    if INTERFACE_IP:
+        mreq = group + socket.inet_aton(INTERFACE_IP)
+    else:
+        mreq = struct.pack('4sL', group, socket.INADDR_ANY)
     s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
     return s
 
 
+# Create UDP socket for sending multicasts, which don't leave the local network
+def setup_multicast_sender_socket():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    if INTERFACE_IP:
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(INTERFACE_IP))
+    return s
+
+
 def encode_message(command, sender, contents='', clock=None):
-    message_dict = {'command': command, 'sender': sender, 'contents': contents, 'clock': clock}
-    return repr(message_dict).encode()
+    if WIRE_FORMAT == 'binary':
+        message = codec.encode(command, sender, contents, clock)
+    else:
+        message_dict = {'command': command, 'sender': sender, 'contents': contents, 'clock': clock}
+        message = repr(message_dict).encode()
+    if COMPRESSION and len(message) >= COMPRESS_MIN_SIZE:
+        return compress_message(message)
+    return message
 
 
 def decode_message(message):
+    if is_compressed(message):
+        message = decompress_message(message)
+    if codec.is_binary(message):
+        return codec.decode(message)
     return ast.literal_eval(message.decode())
 
 
+"""
+Compression
+A chat is a few dozen bytes of text in a message that is mostly the same every time, the field names,
+the command and the addresses. Compressing each message on its own would gain little, as there is nothing in
+a short message for it to refer back to. So every message is compressed with a preset dictionary
+that already holds messages like the ones the chatroom sends, in both wire formats, and only what differs from them
+is left to be sent
+The dictionary has to be the same on every node, and the same as when the messages in a chat log were written
+Raw deflate is used, which leaves out the header and checksum, and a 2 KiB window, which makes setting up
+a compressor for each message cheap. Compressed messages start with COMPRESSED_MAGIC
+"""
+COMPRESSED_MAGIC = 0xB2
+COMPRESSED_PREFIX = bytes((COMPRESSED_MAGIC,))
+COMPRESSION_WINDOW_BITS = -11
+COMPRESSION_LEVEL = 6
+
+
+def build_compression_dictionary():
+    sender = ('192.168.0.1', 50000)
+    templates = [('BATCH', sender, {'chats': [{'chat_sender': 1, 'chat_contents': ''}] * 2}, [1, 2]),
+                 ('SERV', sender, f'{sender[0]} has joined the chat', [1]),
+                 ('SERV', sender, f'{sender[0]} has left the room', [1]),
+                 ('CHAT', sender, {'chat_sender': sender, 'chat_contents': ''}, [1]),
+                 ('CHAT', sender, {'chat_sender': 1, 'chat_contents': ''}, [1])]
+    # The end of the dictionary is the cheapest to refer back to, so the most common message goes last
+    samples = []
+    for command, sender, contents, clock in templates:
+        samples.append(repr({'command': command, 'sender': sender, 'contents': contents, 'clock': clock}).encode())
+        samples.append(codec.encode(command, sender, contents, clock))
+    return b''.join(samples)
+
+
+COMPRESSION_DICTIONARY = build_compression_dictionary()
+
+
+def is_compressed(message):
+    return len(message) > 0 and message[0] == COMPRESSED_MAGIC
+
+
+# Returns the message as it is if compressing doesn't make it smaller
+def compress_message(message):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, COMPRESSION_WINDOW_BITS,
+                                  zdict=COMPRESSION_DICTIONARY)
+    compressed = COMPRESSED_PREFIX + compressor.compress(message) + compressor.flush()
+    if len(compressed) >= len(message):
+        return message
+    metrics.count('compression.bytes_saved', len(message) - len(compressed))
+    return compressed
+
+
+def decompress_message(message):
+    decompressor = zlib.decompressobj(COMPRESSION_WINDOW_BITS, zdict=COMPRESSION_DICTIONARY)
+    return decompressor.decompress(memoryview(message)[1:]) + decompressor.flush()
+
+
+# Splits a multicasted BATCH into the CHAT messages it holds, one for each clock value in its range
+# Any other message is returned on its own
+def unpack_multicast(message):
+    if message['command'] != 'BATCH':
+        return [message]
+    first = message['clock'][0]
+    return [{'command': 'CHAT', 'sender': message['sender'], 'contents': chat, 'clock': [first + i]}
+            for i, chat in enumerate(message['contents']['chats'])]
+
+
+# Multicast group for a chat room, picked from a hash of the room name within the unassigned block above
+# The groups in taken are skipped, so that no two rooms share a group
+def room_group(name, taken=()):
+    start = zlib.crc32(name.encode())
+    for i in range(254 * 256):
+        n = (start + i) % (254 * 256)
+        group = (f'224.3.{1 + n // 256}.{n % 256}', ML_CLIENT_PORT)
+        if group not in taken and group not in (MG_SERVER, MG_CLIENT):
+            return group
+    raise ValueError('No multicast groups left for rooms')
+
+
 def format_join_quit(node_type, inform_others, address):
     return {'node_type': node_type, 'inform_others': inform_others, 'address': address}
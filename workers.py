@@ -0,0 +1,67 @@
+#!/usr/bin/env python3.10
+# Runs handlers on a fixed number of worker threads, apart from the threads that read the connections
+import logging
+import queue
+import threading
+from time import monotonic
+
+from metrics import metrics
+
+log = logging.getLogger('workers')
+
+
+# Work submitted with the same key, like the address of the node that sent a message, always goes to the same worker,
+# so it runs in the order it was submitted. Work with different keys can run at the same time on different workers
+# Each worker has a queue of at most queue_size items. Submitting blocks while it is full, which slows down the sender
+# that is filling it rather than letting the queue grow without limit
+# How long work waits in the queues and how long it takes to run is recorded in the metrics, under name
+class WorkerPool:
+    def __init__(self, workers=4, queue_size=256, name='workers'):
+        self.name = name
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.threads = []
+
+    def start(self):
+        for i, work_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.run_worker, args=(work_queue,), name=f'{self.name}-{i}')
+            thread.start()
+            self.threads.append(thread)
+
+    # Returns False if the worker's queue is full and block isn't set, in which case nothing is submitted
+    def submit(self, key, function, *args, block=True):
+        work_queue = self.queues[hash(key) % len(self.queues)]
+        item = (monotonic(), function, args)
+        try:
+            work_queue.put_nowait(item)
+        except queue.Full:
+            metrics.count(f'{self.name}.queue_full')
+            if not block:
+                return False
+            start = monotonic()
+            work_queue.put(item)
+            metrics.observe(f'{self.name}.blocked_seconds', monotonic() - start)
+        return True
+
+    # Stops the workers once everything submitted before this has run
+    def stop(self):
+        for work_queue in self.queues:
+            work_queue.put(None)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    # Number of items waiting in the queues
+    def depth(self):
+        return sum(work_queue.qsize() for work_queue in self.queues)
+
+    def run_worker(self, work_queue):
+        while (item := work_queue.get()) is not None:
+            submitted, function, args = item
+            start = monotonic()
+            metrics.observe(f'{self.name}.queue_seconds', start - submitted)
+            try:
+                function(*args)
+            except Exception as e:
+                log.error('Error handling command: %r', e)
+            metrics.observe(f'{self.name}.handler_seconds', monotonic() - start)